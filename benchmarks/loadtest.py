@@ -0,0 +1,215 @@
+#
+# Load-testing and memory-profiling harness for the converter service
+#
+# Each simulated user goes through what county staff do: upload the SEMS election files, convert them,
+# download the election definition, upload the election definition and tallies, convert them and download
+# the SEMS results. Users run concurrently against the Flask test client, or against a running server
+# with --url, and we report latency percentiles and throughput per endpoint.
+#
+# Then each stage of a conversion is run on its own under tracemalloc to report its peak memory.
+#
+# --scale copies every precinct of the sample election that many times, for bigger tallies files.
+#
+# python -m benchmarks.loadtest [--users 4] [--iterations 5] [--scale 1] [--url http://localhost:3003] [--json]
+#
+
+import argparse, json, os, sys, tempfile, threading, time, tracemalloc, uuid
+import urllib.error, urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+PARENT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+SAMPLE_FILES = os.path.join(PARENT_DIR, 'sample_files')
+SAMPLE_MAIN_FILE = os.path.join(SAMPLE_FILES, '53_5-2-2019.txt')
+SAMPLE_CANDIDATE_MAPPING_FILE = os.path.join(SAMPLE_FILES, '53_CANDMAP_5-2-2019.txt')
+SAMPLE_ELECTION_FILE = os.path.join(SAMPLE_FILES, '53_expected-election.json')
+SAMPLE_TALLIES_FILE = os.path.join(SAMPLE_FILES, '53_tallies.json')
+
+
+def scale_files(directory, scale):
+    # copies of every precinct, with their tallies, under new ids
+    election = json.loads(open(SAMPLE_ELECTION_FILE, "r").read())
+    tallies = json.loads(open(SAMPLE_TALLIES_FILE, "r").read())
+
+    def copy_id(precinct_id, copy):
+        return precinct_id if copy == 0 else "%s%03d" % (precinct_id, copy)
+
+    election["precincts"] = [dict(p, id=copy_id(p["id"], copy)) for copy in range(scale) for p in election["precincts"]]
+    for ballot_style in election["ballotStyles"]:
+        ballot_style["precincts"] = [copy_id(p, copy) for copy in range(scale) for p in ballot_style["precincts"]]
+    tallies["talliesByPrecinct"] = {copy_id(p, copy): t for copy in range(scale) for p, t in tallies["talliesByPrecinct"].items()}
+
+    election_path = os.path.join(directory, "scaled-election.json")
+    tallies_path = os.path.join(directory, "scaled-tallies.json")
+    open(election_path, "w").write(json.dumps(election))
+    open(tallies_path, "w").write(json.dumps(tallies))
+    return election_path, tallies_path
+
+
+class FlaskClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, path):
+        return self.client.get(path).status_code
+
+    def post(self, path, data=None, file_path=None):
+        data = dict(data or {})
+        if file_path:
+            data["file"] = open(file_path, "rb")
+        return self.client.post(path, data=data, content_type="multipart/form-data").status_code
+
+
+class HTTPClient:
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def request(self, path, body=None, headers={}):
+        request = urllib.request.Request(self.url + path, data=body, headers=headers)
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def get(self, path):
+        return self.request(path)
+
+    def post(self, path, data=None, file_path=None):
+        boundary = uuid.uuid4().hex
+        parts = []
+        for name, value in (data or {}).items():
+            parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, name, value)).encode("utf-8"))
+        if file_path:
+            parts.append(('--%s\r\nContent-Disposition: form-data; name="file"; filename="%s"\r\n\r\n' % (boundary, os.path.basename(file_path))).encode("utf-8"))
+            parts.append(open(file_path, "rb").read() + b"\r\n")
+        parts.append(("--%s--\r\n" % boundary).encode("utf-8"))
+        return self.request(path, b"".join(parts), {"Content-Type": "multipart/form-data; boundary=%s" % boundary})
+
+
+def user_session(client, election_path, tallies_path, timings, errors, lock):
+    steps = [
+        ("POST /convert/election/submitfile", lambda: client.post('/convert/election/submitfile', {'name': 'SEMS main file'}, SAMPLE_MAIN_FILE)),
+        ("POST /convert/election/submitfile", lambda: client.post('/convert/election/submitfile', {'name': 'SEMS candidate mapping file'}, SAMPLE_CANDIDATE_MAPPING_FILE)),
+        ("POST /convert/election/process", lambda: client.post('/convert/election/process')),
+        ("GET /convert/election/output", lambda: client.get('/convert/election/output?name=Vx%20Election%20Definition')),
+        ("POST /convert/tallies/submitfile", lambda: client.post('/convert/tallies/submitfile', {'name': 'Vx Election Definition'}, election_path)),
+        ("POST /convert/tallies/submitfile", lambda: client.post('/convert/tallies/submitfile', {'name': 'Vx Tallies'}, tallies_path)),
+        ("POST /convert/tallies/process", lambda: client.post('/convert/tallies/process')),
+        ("GET /convert/tallies/output", lambda: client.get('/convert/tallies/output?name=SEMS%20Results')),
+    ]
+    for endpoint, step in steps:
+        start = time.perf_counter()
+        status = step()
+        elapsed = time.perf_counter() - start
+        with lock:
+            timings.setdefault(endpoint, []).append(elapsed)
+            if status >= 500:
+                errors[endpoint] = errors.get(endpoint, 0) + 1
+
+
+def percentile(sorted_values, fraction):
+    # nearest rank
+    return sorted_values[max(0, int(round(fraction * len(sorted_values))) - 1)]
+
+
+def load_test(make_client, election_path, tallies_path, users, iterations):
+    timings = {}
+    errors = {}
+    lock = threading.Lock()
+
+    def run_user(_):
+        client = make_client()
+        for _ in range(iterations):
+            user_session(client, election_path, tallies_path, timings, errors, lock)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        list(pool.map(run_user, range(users)))
+    wall_time = time.perf_counter() - start
+
+    report = {}
+    for endpoint, values in timings.items():
+        values = sorted(values)
+        report[endpoint] = {
+            "requests": len(values),
+            "errors": errors.get(endpoint, 0),
+            "p50": percentile(values, 0.5),
+            "p90": percentile(values, 0.9),
+            "p99": percentile(values, 0.99),
+            "max": values[-1],
+            "throughput": len(values) / wall_time
+        }
+    return report
+
+
+def profile_memory(election_path, tallies_path):
+    from converter import SEMSinput, SEMSoutput
+
+    results = {}
+    stages = [
+        ("election conversion", lambda _: SEMSinput.process_election_files(SAMPLE_MAIN_FILE, SAMPLE_CANDIDATE_MAPPING_FILE)),
+        ("load election and tallies", lambda _: (json.loads(open(election_path, "r").read()), json.loads(open(tallies_path, "r").read()))),
+        ("index election", lambda loaded: (SEMSoutput.index_election(loaded[0]), loaded[1])),
+        ("generate rows", lambda indexed: list(SEMSoutput.tallies_rows(*indexed))),
+        ("format SEMS rows", lambda rows: "".join(SEMSoutput.sems_chunks(rows))),
+    ]
+
+    # tracing starts afresh for each stage, so its peak is just what the stage allocated
+    # (tracemalloc.reset_peak would do, but it needs Python 3.9)
+    previous = None
+    for name, stage in stages:
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = stage(previous)
+        elapsed = time.perf_counter() - start
+        results[name] = {"peakBytes": tracemalloc.get_traced_memory()[1], "seconds": elapsed}
+        tracemalloc.stop()
+        if name != "election conversion":
+            previous = result
+
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Load-test the converter endpoints and profile conversion memory")
+    parser.add_argument("--users", type=int, default=4, help="concurrent users")
+    parser.add_argument("--iterations", type=int, default=5, help="sessions per user")
+    parser.add_argument("--scale", type=int, default=1, help="copies of each sample precinct in the tallies")
+    parser.add_argument("--url", help="base URL of a running server, instead of the Flask test client")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        election_path, tallies_path = scale_files(directory, args.scale)
+
+        if args.url:
+            make_client = lambda: HTTPClient(args.url)
+        else:
+            # importing the server resets its workspace, so give it a scratch one
+            os.environ["MODULE_SEMS_CONVERTER_WORKSPACE"] = os.path.join(directory, "workspace")
+            os.mkdir(os.environ["MODULE_SEMS_CONVERTER_WORKSPACE"])
+            from converter.core import app
+            make_client = lambda: FlaskClient(app)
+
+        report = {
+            "endpoints": load_test(make_client, election_path, tallies_path, args.users, args.iterations),
+            "memory": profile_memory(election_path, tallies_path)
+        }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print("%-36s %8s %7s %9s %9s %9s %9s %10s" % ("endpoint", "requests", "errors", "p50 ms", "p90 ms", "p99 ms", "max ms", "req/s"))
+    for endpoint, stats in report["endpoints"].items():
+        print("%-36s %8d %7d %9.1f %9.1f %9.1f %9.1f %10.1f" % (
+            endpoint, stats["requests"], stats["errors"], stats["p50"] * 1000, stats["p90"] * 1000, stats["p99"] * 1000, stats["max"] * 1000, stats["throughput"]))
+    print()
+    print("%-36s %12s %9s" % ("conversion stage", "peak KiB", "ms"))
+    for stage, stats in report["memory"].items():
+        print("%-36s %12.1f %9.1f" % (stage, stats["peakBytes"] / 1024, stats["seconds"] * 1000))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
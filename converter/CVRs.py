@@ -0,0 +1,205 @@
+#
+# Vx CVR files
+#
+# A CVR file has one JSON object per line, one line per ballot:
+# {"750000015":["yes"],...,"_precinctId":"6522","_ballotStyleId":"5","_ballotId":"yZnl...","_testBallot":false,"_scannerId":"scanner-3",...}
+#
+# Finding the ballots of one precinct would otherwise mean decoding every line of the file, so we keep an
+# index of the byte offset of each line by precinct, ballot style and scanner. It's built in one pass over
+# the mmap'ed file, pulling those fields out of each line with a regex instead of decoding the JSON, and
+# saved next to the CVR file. When the CVR file has only been appended to since, just the new lines are indexed.
+#
+# Only complete lines are indexed, so a line that is still being written is picked up next time. The last
+# line of a file doesn't always end with a newline, so it counts as complete as soon as it decodes.
+#
+# When CVRs are read for tallying, test ballots and ballots that were already read (a scanner's export
+# imported twice, or overlapping exports) are left out and reported, see unique_cvrs.
+#
+
+import hashlib, json, mmap, os, re
+
+INDEX_FIELDS = {
+    "precincts": re.compile(rb'"_precinctId"\s*:\s*"([^"]*)"'),
+    "ballotStyles": re.compile(rb'"_ballotStyleId"\s*:\s*"([^"]*)"'),
+    "scanners": re.compile(rb'"_scannerId"\s*:\s*"([^"]*)"')
+}
+
+# how much of the end of the indexed part of the file we hash, to notice a file that was rewritten rather than appended to
+TAIL_SIZE = 4096
+
+def cvr_index_path(cvr_file_path):
+    return cvr_file_path + ".index.json"
+
+def tail_hash(tail):
+    return hashlib.sha1(tail).hexdigest()
+
+def empty_cvr_index():
+    index = {"size": 0, "tail": tail_hash(b""), "lines": 0}
+    for field in INDEX_FIELDS:
+        index[field] = {}
+    return index
+
+def is_complete_line(line):
+    try:
+        json.loads(line)
+        return True
+    except ValueError:
+        return False
+
+def build_cvr_index(cvr_file_path, index=None):
+    # index the file, or if an index is passed in, extend it with the lines after the part it covers
+    index = index or empty_cvr_index()
+
+    with open(cvr_file_path, "rb") as cvr_file:
+        if os.fstat(cvr_file.fileno()).st_size == 0:
+            return index
+
+        with mmap.mmap(cvr_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = index["size"]
+            while offset < len(data):
+                line_end = data.find(b"\n", offset)
+                if line_end < 0:
+                    line_end = len(data)
+                    if not is_complete_line(data[offset:line_end]):
+                        break
+
+                line = data[offset:line_end]
+                if line.strip():
+                    index["lines"] += 1
+                    for field, pattern in INDEX_FIELDS.items():
+                        match = pattern.search(line)
+                        if match:
+                            index[field].setdefault(match.group(1).decode("utf-8"), []).append(offset)
+                offset = min(line_end + 1, len(data))
+
+            index["size"] = offset
+            index["tail"] = tail_hash(data[max(0, offset - TAIL_SIZE):offset])
+
+    return index
+
+def is_appended_to(cvr_file_path, index):
+    # the file still starts with what was indexed
+    with open(cvr_file_path, "rb") as cvr_file:
+        if os.fstat(cvr_file.fileno()).st_size < index["size"]:
+            return False
+        cvr_file.seek(max(0, index["size"] - TAIL_SIZE))
+        return tail_hash(cvr_file.read(min(index["size"], TAIL_SIZE))) == index["tail"]
+
+def update_cvr_index(cvr_file_path):
+    # load the saved index, bring it up to date with the file, and save it again
+    index = None
+    index_path = cvr_index_path(cvr_file_path)
+    if os.path.isfile(index_path):
+        index = json.loads(open(index_path, "r").read())
+        if not is_appended_to(cvr_file_path, index):
+            index = None
+
+    previous_size = index["size"] if index else None
+    index = build_cvr_index(cvr_file_path, index)
+
+    if index["size"] != previous_size:
+        with open(index_path, "w") as index_file:
+            index_file.write(json.dumps(index))
+
+    return index
+
+def cvr_lines(cvr_file_path, index):
+    # the line number and content of each CVR line, stopping at the end of the indexed lines
+    with open(cvr_file_path, "rb") as cvr_file:
+        position = 0
+        for line_number, line in enumerate(cvr_file, 1):
+            if position >= index["size"]:
+                return
+            position += len(line)
+            if line.strip():
+                yield line_number, line
+
+def read_cvrs(cvr_file_path, precinct_id=None, ballot_style_id=None, scanner_id=None):
+    # decode just the CVRs that match all the given ids
+    index = update_cvr_index(cvr_file_path)
+
+    selected_offsets = None
+    for field, value in [("precincts", precinct_id), ("ballotStyles", ballot_style_id), ("scanners", scanner_id)]:
+        if value is None:
+            continue
+        offsets = set(index[field].get(value, []))
+        selected_offsets = offsets if selected_offsets is None else selected_offsets & offsets
+
+    if selected_offsets is None:
+        for _, line in cvr_lines(cvr_file_path, index):
+            yield json.loads(line)
+        return
+
+    with open(cvr_file_path, "rb") as cvr_file:
+        for offset in sorted(selected_offsets):
+            cvr_file.seek(offset)
+            yield json.loads(cvr_file.readline())
+
+#
+# Test ballots and duplicate ballots
+#
+# Ballot ids are remembered as the CVRs are read, in a compact set: an open-addressing hash table of 16-byte
+# blake2b fingerprints in a bytearray, with linear probing, kept at most half full. That's 32 to 64 bytes a
+# ballot, a fraction of a Python set of id strings, so millions of ballots are no trouble. Fingerprints that
+# long won't collide in any real election.
+#
+
+FINGERPRINT_SIZE = 16
+EMPTY_FINGERPRINT = bytes(FINGERPRINT_SIZE)
+
+def new_ballot_id_set(capacity=1024):
+    # capacity is a power of 2
+    return {"table": bytearray(capacity * FINGERPRINT_SIZE), "capacity": capacity, "count": 0}
+
+def ballot_id_fingerprint(ballot_id):
+    fingerprint = hashlib.blake2b(ballot_id.encode("utf-8"), digest_size=FINGERPRINT_SIZE).digest()
+    # all zeroes marks an empty slot
+    if fingerprint == EMPTY_FINGERPRINT:
+        fingerprint = b"\x01" + fingerprint[1:]
+    return fingerprint
+
+def insert_fingerprint(ballot_ids, fingerprint):
+    # True if the fingerprint wasn't in the set yet
+    table = ballot_ids["table"]
+    mask = ballot_ids["capacity"] - 1
+    slot = int.from_bytes(fingerprint[:8], "little") & mask
+    while True:
+        offset = slot * FINGERPRINT_SIZE
+        slot_fingerprint = table[offset:offset + FINGERPRINT_SIZE]
+        if slot_fingerprint == fingerprint:
+            return False
+        if slot_fingerprint == EMPTY_FINGERPRINT:
+            table[offset:offset + FINGERPRINT_SIZE] = fingerprint
+            ballot_ids["count"] += 1
+            return True
+        slot = (slot + 1) & mask
+
+def add_ballot_id(ballot_ids, ballot_id):
+    # True if the ballot id wasn't in the set yet
+    if (ballot_ids["count"] + 1) * 2 > ballot_ids["capacity"]:
+        old_table = ballot_ids["table"]
+        ballot_ids.update(new_ballot_id_set(ballot_ids["capacity"] * 2))
+        for offset in range(0, len(old_table), FINGERPRINT_SIZE):
+            fingerprint = bytes(old_table[offset:offset + FINGERPRINT_SIZE])
+            if fingerprint != EMPTY_FINGERPRINT:
+                insert_fingerprint(ballot_ids, fingerprint)
+
+    return insert_fingerprint(ballot_ids, ballot_id_fingerprint(ballot_id))
+
+def unique_cvrs(cvr_file_paths, skipped, include_test_ballots=False):
+    # the CVRs of all the files, in one pass, leaving out test ballots (unless include_test_ballots)
+    # and ballots already read from this file or an earlier one. Those are appended to skipped as
+    # {"type": "test-ballot" | "duplicate-ballot", "ballotId": ..., "file": ..., "line": ...}
+    ballot_ids = new_ballot_id_set()
+    for cvr_file_path in cvr_file_paths:
+        for line_number, line in cvr_lines(cvr_file_path, update_cvr_index(cvr_file_path)):
+            cvr = json.loads(line)
+            ballot_id = cvr.get("_ballotId")
+            if cvr.get("_testBallot") and not include_test_ballots:
+                kind = "test-ballot"
+            elif ballot_id is not None and not add_ballot_id(ballot_ids, ballot_id):
+                kind = "duplicate-ballot"
+            else:
+                yield cvr
+                continue
+            skipped.append({"type": kind, "ballotId": ballot_id, "file": cvr_file_path, "line": line_number})
@@ -0,0 +1,99 @@
+#
+# Structural diff of two SEMS result files
+#
+# Rows are matched by county/precinct/contest/candidate rather than by line, so the order of rows doesn't matter.
+#
+# Most of the time two exports differ in only a few precincts, so we first group the raw lines by precinct
+# and hash each precinct's block of lines (sorted, so order doesn't matter either). Only precincts whose
+# hashes differ get parsed and compared row by row.
+#
+# python -m converter.SEMSdiff before.txt after.txt
+#
+
+import hashlib, sys
+
+from .SEMSoutput import parse_sems_results
+
+def precinct_blocks(lines):
+    # group raw lines by their (county_id, precinct_id) prefix without parsing them as CSV,
+    # ids are plain numbers so they never contain quotes or commas
+    blocks = {}
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+        county_id, precinct_id, _ = line.split('","', 2)
+        blocks.setdefault((county_id[1:], precinct_id), []).append(line)
+    return blocks
+
+def block_hash(lines):
+    return hashlib.sha1("\n".join(sorted(lines)).encode("utf-8")).digest()
+
+def read_precinct_blocks(sems_results_file_path):
+    with open(sems_results_file_path, "r", newline="") as sems_results_file:
+        return precinct_blocks(sems_results_file)
+
+def diff_sems_results(before_file_path, after_file_path):
+    before_blocks = read_precinct_blocks(before_file_path)
+    after_blocks = read_precinct_blocks(after_file_path)
+
+    diff = {
+        "added": [],
+        "removed": [],
+        "changed": [],
+        "identicalPrecincts": 0,
+        "precincts": {}
+    }
+
+    for precinct_key in sorted(set(before_blocks) | set(after_blocks)):
+        before_lines = before_blocks.get(precinct_key, [])
+        after_lines = after_blocks.get(precinct_key, [])
+        if block_hash(before_lines) == block_hash(after_lines):
+            diff["identicalPrecincts"] += 1
+            continue
+
+        before = parse_sems_results(before_lines)
+        after = parse_sems_results(after_lines)
+        for key in sorted(set(before) | set(after)):
+            if key not in after:
+                diff["removed"].append(before[key])
+            elif key not in before:
+                diff["added"].append(after[key])
+            elif before[key] != after[key]:
+                diff["changed"].append([before[key], after[key]])
+
+        diff["precincts"][precinct_key[1]] = {
+            "before": sum(row[10] for row in before.values()),
+            "after": sum(row[10] for row in after.values())
+        }
+
+    return diff
+
+def format_diff(diff):
+    def describe(row):
+        return "precinct %s, contest %s (%s), candidate %s (%s)" % (row[1], row[2], row[3], row[6], row[7])
+
+    lines = []
+    for row in diff["removed"]:
+        lines.append("- %s: %d" % (describe(row), row[10]))
+    for row in diff["added"]:
+        lines.append("+ %s: %d" % (describe(row), row[10]))
+    for before_row, after_row in diff["changed"]:
+        lines.append("~ %s: %d -> %d" % (describe(after_row), before_row[10], after_row[10]))
+
+    for precinct_id, totals in diff["precincts"].items():
+        lines.append("precinct %s total: %d -> %d" % (precinct_id, totals["before"], totals["after"]))
+
+    lines.append("%d added, %d removed, %d changed, %d precincts differ, %d precincts identical" % (
+        len(diff["added"]), len(diff["removed"]), len(diff["changed"]),
+        len(diff["precincts"]), diff["identicalPrecincts"]))
+
+    return "\n".join(lines)
+
+def has_differences(diff):
+    return len(diff["precincts"]) > 0
+
+if __name__ == "__main__": # pragma: no cover this is the main
+    sems_diff = diff_sems_results(sys.argv[1], sys.argv[2])
+    print(format_diff(sems_diff))
+    sys.exit(1 if has_differences(sems_diff) else 0)
@@ -72,11 +72,13 @@
 # - find all the contests for those districts
 
 
-import csv, json, sqlite3, sys, re
+import csv, hashlib, json, os, sqlite3, sys, re
 from dateutil.parser import parse as date_parse
 from datetime import timedelta, timezone
 
 from .counties import COUNTIES
+from . import SEMSoutput
+from .profiling import profile_call, save_profile
 
 ELECTION_TABLES = {
     "1": {"name": "election", "fields": ["title", "date"]},
@@ -90,6 +92,14 @@ ELECTION_TABLES = {
     "9": {"name": "sems_candidates", "fields": ["county_code", "contest_id", "candidate_id", "candidate_sems_id"]}
 }
 
+# for anyone querying a saved database
+ELECTION_INDEXES = [
+    "create index splits_ballot_style on splits (ballot_style)",
+    "create index split_districts_split on split_districts (split_id)",
+    "create index contests_label on contests (label)",
+    "create index candidates_contest on candidates (contest_id, candidate_id)",
+    "create index sems_candidates_contest on sems_candidates (contest_id, candidate_id)"
+]
 
 FULL_PARTY_NAMES = {
     "democrat": "Democratic Party",
@@ -102,15 +112,21 @@ def full_party_name(short_party_name):
 def cleanup_text(text):
     return text.replace("\\n", "\n").strip("\n")
 
-def process_election_files(election_details_file_path, candidate_map_file_path):
-    election_details_file = open(election_details_file_path, "r")
-    candidate_map_file = open(candidate_map_file_path, "r")
-
-    # the CSV files have an extraneous space at the beginning of all fields other than the first.
-    election_details_csv = csv.reader(election_details_file, skipinitialspace=True)
-    candidate_map_csv = csv.reader(candidate_map_file, skipinitialspace=True)
-    
-    db = sqlite3.connect(":memory:")
+def read_election_rows(election_details_file_path, candidate_map_file_path):
+    rows = []
+    for file_path in [election_details_file_path, candidate_map_file_path]:
+        with open(file_path, "r") as the_file:
+            # the CSV files have an extraneous space at the beginning of all fields other than the first.
+            for row in csv.reader(the_file, skipinitialspace=True):
+                # windows ctrl-m issue, shows up as an extra row
+                if len(row) > 0 and row[0] in ELECTION_TABLES:
+                    rows.append(row)
+    return rows
+
+def election_db(rows, db_path=None):
+    if db_path and os.path.isfile(db_path):
+        os.remove(db_path)
+    db = sqlite3.connect(db_path or ":memory:")
 
     # this returns rows that behave like dictionaries instead of arrays
     db.row_factory = sqlite3.Row
@@ -124,15 +140,8 @@ def process_election_files(election_details_file_path, candidate_map_file_path):
         sql = "create table %s (%s)" % (table_def["name"], ",".join(fields))
         c.execute(sql)
 
-    def process_row(row):
-        # windows ctrl-m issue, shows up as an extra row
-        if len(row) == 0:
-            return
-        table_def = ELECTION_TABLES.get(row[0], None)
-
-        if not table_def:
-            return
-
+    for row in rows:
+        table_def = ELECTION_TABLES[row[0]]
         fields = table_def["fields"]
         value_placeholders = ["?"] * len(fields)
 
@@ -145,33 +154,9 @@ def process_election_files(election_details_file_path, candidate_map_file_path):
         
         c.execute(sql, values)
 
-    for row in election_details_csv:
-        process_row(row)
-
-    for row in candidate_map_csv:
-        process_row(row)
-
-    
-    # now it's all in in-memory sqlite
-
-    # the county ID is in the sems_candidates table (only stable place it appears)
-    sql = "select distinct(county_code) as county_code from sems_candidates"
-    county_id = c.execute(sql).fetchone()['county_code']
-
-    # basic info
-    sql = "select title, date from election"
-    election_title, election_date = c.execute(sql).fetchone()
-
-    # parties
-    sql = "select party_id, label, abbrev from parties"
-    parties = [{"id": r['party_id'], "name": r['label'], "fullName": full_party_name(r['label']), "abbrev": r['abbrev']} for r in c.execute(sql).fetchall()]
-    parties_by_abbrev = dict([[p["abbrev"], p["id"]] for p in parties])
-    parties_by_id = dict([[p["id"], p] for p in parties])
-
-    # districts
-    sql = "select district_id, label from districts"
-    districts = [{"id": r['district_id'], "name": r['label']} for r in c.execute(sql).fetchall()]
+    return db
 
+def election_contests(c, county_id):
     # look for either-neither contests, which have the same label and description
     sql = "select label, contest_text from contests where type = '1' group by label, contest_text having count(*) = 2"
     either_neither_labels = [r['label'] for r in c.execute(sql).fetchall()]
@@ -311,8 +296,10 @@ def process_election_files(election_details_file_path, candidate_map_file_path):
                 "id": second_option['candidate_id'],
                 "label": cleanup_text(second_option['label_on_ballot']).split("\n")[1]
             }
-            
-        
+
+    return contests
+
+def election_ballot_styles(c, parties_by_abbrev):
     sql = "select precinct_id, precinct_label from splits group by precinct_id, precinct_label"
     precincts = [{"id": r['precinct_id'], "name": r['precinct_label']} for r in c.execute(sql)]
         
@@ -332,7 +319,39 @@ def process_election_files(election_details_file_path, candidate_map_file_path):
     for ballot_style in ballot_styles:
         ballot_style["precincts"] = [r['precinct_id'] for r in c.execute(sql_precincts, [ballot_style["id"]])]
         ballot_style["districts"] = [r['district_id'] for r in c.execute(sql_districts, [ballot_style["id"]])]
-    
+
+    return precincts, ballot_styles
+
+def process_election_files(election_details_file_path, candidate_map_file_path, db_path=None):
+    # with a db_path, the SEMS tables are saved there along with the Vx election model used for SQL exports
+    return process_election_rows(read_election_rows(election_details_file_path, candidate_map_file_path), db_path)
+
+def process_election_rows(rows, db_path=None):
+    db = election_db(rows, db_path)
+    c = db.cursor()
+
+    # now it's all in sqlite
+
+    # the county ID is in the sems_candidates table (only stable place it appears)
+    sql = "select distinct(county_code) as county_code from sems_candidates"
+    county_id = c.execute(sql).fetchone()['county_code']
+
+    # basic info
+    sql = "select title, date from election"
+    election_title, election_date = c.execute(sql).fetchone()
+
+    # parties
+    sql = "select party_id, label, abbrev from parties"
+    parties = [{"id": r['party_id'], "name": r['label'], "fullName": full_party_name(r['label']), "abbrev": r['abbrev']} for r in c.execute(sql).fetchall()]
+    parties_by_abbrev = dict([[p["abbrev"], p["id"]] for p in parties])
+    parties_by_id = dict([[p["id"], p] for p in parties])
+
+    # districts
+    sql = "select district_id, label from districts"
+    districts = [{"id": r['district_id'], "name": r['label']} for r in c.execute(sql).fetchall()]
+
+    contests = election_contests(c, county_id)
+    precincts, ballot_styles = election_ballot_styles(c, parties_by_abbrev)
 
     # set the timezone to be the earliest US timezone (Hawaii standard time)
     # we don't care about exact timezone because we only want the date, but ISO requires the time
@@ -361,11 +380,131 @@ def process_election_files(election_details_file_path, candidate_map_file_path):
         "markThresholds": { "definite": 0.17, "marginal": 0.17 }        
     }
 
+    # the indexes are only added now, because they can change the order rows come back in above
+    if db_path:
+        for sql in ELECTION_INDEXES:
+            c.execute(sql)
+        SEMSoutput.save_election_model(db, vx_election)
+    db.close()
+
     return(vx_election)
 
-def main(main_file, cand_map_file):
-    vx_election = process_election_files(main_file, cand_map_file)
+#
+# Incremental re-conversion
+#
+# SEMS often sends revised files that only change a few candidates or a contest title. We hash the rows of
+# each part of the files: the rows of each contest (its row in section 7, its candidates in section 8 and their
+# SEMS ids in section 9) on their own, the splits and their districts (sections 4 and 5) for the precincts and
+# ballot styles, and everything else together. Compared with the hashes of the previous conversion, that tells
+# us what changed, and only those contests, or the precincts and ballot styles, are converted again, from a
+# database of just the rows they need. The rest of the previous election is kept as is.
+#
+# Some changes touch everything, and mean a full conversion: the election details, districts, parties or county,
+# adding, removing or reordering contests, and changes to measures, which get paired up into either-neither
+# contests across contests.
+#
+
+def rows_hash(rows):
+    return hashlib.sha1(json.dumps(rows).encode("utf-8")).hexdigest()
+
+def election_hashes(rows):
+    sections = {}
+    for row in rows:
+        sections.setdefault(row[0], []).append(row)
+
+    rows_by_contest = {}
+    for row in sections.get("7", []):
+        rows_by_contest[row[1]] = [row]
+    for row in sections.get("8", []):
+        rows_by_contest.setdefault(row[1], []).append(row)
+    for row in sections.get("9", []):
+        rows_by_contest.setdefault(row[2], []).append(row)
+
+    # contest type 0 is a candidate contest, anything else a measure
+    measure_ids = [row[1] for row in sections.get("7", []) if row[3] != "0"]
+    return {
+        "election": rows_hash([sections.get(section, []) for section in "1236"] + [sections.get("9", [[]])[0][1:2]]),
+        "ballotStyles": rows_hash([sections.get(section, []) for section in "45"]),
+        "contestIds": [row[1] for row in sections.get("7", [])],
+        "measures": rows_hash([rows_by_contest[contest_id] for contest_id in measure_ids]),
+        "contests": {contest_id: rows_hash(contest_rows) for contest_id, contest_rows in rows_by_contest.items()}
+    }
+
+def election_changes(previous_hashes, hashes):
+    previous_contests = previous_hashes["contests"]
+    contests = hashes["contests"]
+    return {
+        "election": previous_hashes["election"] != hashes["election"],
+        "ballotStyles": previous_hashes["ballotStyles"] != hashes["ballotStyles"],
+        "measures": previous_hashes["measures"] != hashes["measures"],
+        "contestOrder": previous_hashes["contestIds"] != hashes["contestIds"],
+        "contestsAdded": sorted(set(contests) - set(previous_contests)),
+        "contestsRemoved": sorted(set(previous_contests) - set(contests)),
+        "contestsChanged": sorted(c for c in contests if c in previous_contests and contests[c] != previous_contests[c])
+    }
+
+def reconvert_election_files(election_details_file_path, candidate_map_file_path, previous=None):
+    # converts the files, reusing what it can from previous, which is the conversion returned by an earlier call
+    #
+    # returns the new conversion: {"election": ..., "hashes": ..., "changes": ...}, where changes says what changed,
+    # and what was converted again: "rebuilt" is "everything", "nothing", or a list of "ballotStyles" and/or "contests"
+    rows = read_election_rows(election_details_file_path, candidate_map_file_path)
+    hashes = election_hashes(rows)
+
+    if previous is None:
+        return {"election": process_election_rows(rows), "hashes": hashes, "changes": {"rebuilt": "everything"}}
+
+    changes = election_changes(previous["hashes"], hashes)
+    if changes["election"] or changes["measures"] or changes["contestOrder"]:
+        changes["rebuilt"] = "everything"
+        return {"election": process_election_rows(rows), "hashes": hashes, "changes": changes}
+
+    vx_election = dict(previous["election"])
+    changes["rebuilt"] = []
+
+    if changes["ballotStyles"]:
+        db = election_db([row for row in rows if row[0] in ("4", "5", "6")])
+        parties_by_abbrev = dict([[p["abbrev"], p["id"]] for p in vx_election["parties"]])
+        vx_election["precincts"], vx_election["ballotStyles"] = election_ballot_styles(db.cursor(), parties_by_abbrev)
+        db.close()
+        changes["rebuilt"].append("ballotStyles")
+
+    if changes["contestsChanged"]:
+        # the districts, for the contest sections, and the rows of the contests that changed
+        changed_ids = set(changes["contestsChanged"])
+        db = election_db([row for row in rows if row[0] == "2" or
+                          (row[0] in ("7", "8") and row[1] in changed_ids) or (row[0] == "9" and row[2] in changed_ids)])
+        rebuilt_contests = dict((contest["id"], contest) for contest in election_contests(db.cursor(), vx_election["county"]["id"]))
+        db.close()
+
+        # contests whose district is gone are left out, like a full conversion would
+        vx_election["contests"] = [rebuilt_contests[contest["id"]] if contest["id"] in rebuilt_contests else contest
+                                   for contest in vx_election["contests"]
+                                   if contest["id"] not in changed_ids or contest["id"] in rebuilt_contests]
+        changes["rebuilt"].append("contests")
+
+    if not changes["rebuilt"]:
+        changes["rebuilt"] = "nothing"
+
+    return {"election": vx_election, "hashes": hashes, "changes": changes}
+
+def dump_election(vx_election, compact=False):
+    # compact drops the indentation and separator whitespace, which is a good chunk of the file
+    if compact:
+        return json.dumps(vx_election, separators=(",", ":"))
     return json.dumps(vx_election, indent=2)
 
+def main(main_file, cand_map_file, compact=False, db_path=None):
+    vx_election = process_election_files(main_file, cand_map_file, db_path)
+    return dump_election(vx_election, compact)
+
 if __name__ == "__main__": # pragma: no cover this is the main
-    print(main(sys.argv[1], sys.argv[2]))
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    db_path = [a.split("=", 1)[1] for a in sys.argv[1:] if a.startswith("--database=")]
+    profile_path = [a.split("=", 1)[1] for a in sys.argv[1:] if a.startswith("--profile=")]
+    if profile_path:
+        election_value, profile = profile_call(main, args[0], args[1], compact="--compact" in sys.argv, db_path=db_path[0] if db_path else None)
+        save_profile(profile, profile_path[0])
+    else:
+        election_value = main(args[0], args[1], compact="--compact" in sys.argv, db_path=db_path[0] if db_path else None)
+    print(election_value)
@@ -24,10 +24,17 @@
 # and leaving out the count, and then we'll use group by and joins to get the full rows
 #
 #
-# python makeSEMSResults county_id election.json cvrs.txt sems_results.csv
+# python -m converter.SEMSoutput [--validate] [--summary=summary.json|summary.csv] [--profile=path_prefix] election.json tallies.json [sems_results_to_merge.txt]
 #
 
-import csv, io, json, sqlite3, sys
+import bisect, csv, io, json, sqlite3, sys, threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .CVRs import unique_cvrs
+from .outputs import file_signature
+from .profiling import profile_call, save_profile
 
 NOPARTY_PARTY = {
     "id": "0",
@@ -62,159 +69,731 @@ CANDIDATE_FIELDS = ["county_id", "contest_id", "candidate_id"]
 # which precincts do candidates appear in
 CONTEST_PRECINCTS_FIELDS = ["contest_id", "precinct_id"]
 
-def find_contest(contests, contest_id):
-    for c in contests:
-        if c['type'] != 'ms-either-neither' and c['id'] == contest_id:
-            return c
-        if c['type'] == 'ms-either-neither' and c['eitherNeitherContestId'] == contest_id:
-            return {"id": c['eitherNeitherContestId'],
-                    "title": c['title'],
-                    "type": "yesno",
-                    "yesOption": c['eitherOption'],
-                    "noOption": c['neitherOption'],
-                    "districtId": c['districtId'],
-                    "options": c['eitherNeitherOptions'] if 'eitherNeitherOptions' in c else None}
-        if c['type'] == 'ms-either-neither' and c['pickOneContestId'] == contest_id:
-            return {"id": c['pickOneContestId'],
-                    "title": c["title"],
-                    "type": "yesno",
-                    "yesOption": c['firstOption'],
-                    "noOption": c['secondOption'],
-                    "districtId": c['districtId'],
-                    "options": c['pickOneOptions'] if 'pickOneOptions' in c else None}
-    
+def expanded_contests(c):
+    # ms-either-neither contests are reported to SEMS as two yesno contests
+    if c['type'] != 'ms-either-neither':
+        return [c]
+    return [{"id": c['eitherNeitherContestId'],
+             "title": c['title'],
+             "type": "yesno",
+             "yesOption": c['eitherOption'],
+             "noOption": c['neitherOption'],
+             "districtId": c['districtId'],
+             "options": c['eitherNeitherOptions'] if 'eitherNeitherOptions' in c else None},
+            {"id": c['pickOneContestId'],
+             "title": c["title"],
+             "type": "yesno",
+             "yesOption": c['firstOption'],
+             "noOption": c['secondOption'],
+             "districtId": c['districtId'],
+             "options": c['pickOneOptions'] if 'pickOneOptions' in c else None}]
+
+# the compact model of a contest, see index_election: its seats, its labels (contest_id, contest_title,
+# party_id, party_label), its option rows in SEMS order and the tally keys of its options
+ContestModel = namedtuple("ContestModel", ["seats", "labels", "option_rows", "tally_keys"])
+
+class OptionRow(namedtuple("OptionRow", ["labels", "tally_key", "in_metadata"])):
+    # the labels of a row, from contest_id to candidate_party_label, and where its count comes from:
+    # tally_key in the contest's tallies, or in its metadata if in_metadata
+    __slots__ = ()
+
+    @property
+    def option_id(self):
+        return self.labels[4]
+
+    @property
+    def option_labels(self):
+        # candidate_id, candidate_name, candidate_party_id, candidate_party_label
+        return self.labels[4:]
+
+def contest_model(contest, parties_by_id):
+    def party_labels(party_id):
+        party = parties_by_id[party_id] if party_id is not None else NOPARTY_PARTY
+        return (party_id or "0", party["abbrev"])
 
-def process_tallies_file(election_file_path, vx_results_file_path):
-    election = json.loads(open(election_file_path, "r").read())
-    tallies = json.loads(open(vx_results_file_path, "r").read())
+    contest_labels = (sys.intern(contest["id"]), contest["title"].replace("\n", "\\n")) + party_labels(contest.get("partyId"))
 
-    contests = election["contests"]
+    # option id, name, party id, tally key, in metadata
+    options = [
+        (OVERVOTE_CANDIDATE["id"], OVERVOTE_CANDIDATE["name"], None, "overvotes", True),
+        (UNDERVOTE_CANDIDATE["id"], UNDERVOTE_CANDIDATE["name"], None, "undervotes", True)
+    ]
+    if contest["type"] == "candidate":
+        for candidate in contest["candidates"]:
+            options.append((candidate["id"], candidate.get("name", candidate.get("label")), candidate.get("partyId"), candidate["id"], False))
+        if contest["allowWriteIns"]:
+            options.append((WRITEIN_CANDIDATE["id"], WRITEIN_CANDIDATE["name"], None, INTERNAL_WRITE_IN_ID, False))
+    elif contest["type"] == "yesno":
+        for option, tally_key in [(contest["yesOption"], "yes"), (contest["noOption"], "no")]:
+            options.append((option["id"], option.get("name", option.get("label")), None, tally_key, False))
+
+    rows = tuple(sorted((OptionRow(contest_labels + (sys.intern(option_id), name) + party_labels(party_id), tally_key, in_metadata)
+                         for option_id, name, party_id, tally_key, in_metadata in options), key=lambda row: row.option_id))
+    tally_keys = frozenset(row.tally_key for row in rows if not row.in_metadata)
+    return ContestModel(contest.get("seats", 1), contest_labels, rows, tally_keys)
+
+def index_election(election):
+    # lookups for generating rows, built once per election, so that exporting
+    # a few precincts or contests only costs the rows that are asked for
+    #
+    # contestsById holds a compact model of each contest rather than the election's dicts, a ContestModel
+    # with an OptionRow for each row. The labels of every row are worked out here once, and ids are interned,
+    # so rows share them.
     ballot_styles = election["ballotStyles"]
-    precincts = election["precincts"]
     parties = election["parties"] + [NOPARTY_PARTY]
-    county_id = election["county"]["id"]
-    tallies_by_precinct = tallies["talliesByPrecinct"]
+    # reversed so that the first party with a given id wins
+    parties_by_id = {p["id"]: p for p in reversed(parties)}
 
-    contests_by_precinct = {p["id"]: [] for p in precincts}
-    for contest in contests:
-        contest_ballot_styles = [bs for bs in ballot_styles if contest["districtId"] in bs["districts"]]
+    contests_by_id = {}
+    contests_by_precinct = {sys.intern(p["id"]): [] for p in election["precincts"]}
+    precincts_by_contest = {}
+    for c in election["contests"]:
+        contest_ballot_styles = [bs for bs in ballot_styles if c["districtId"] in bs["districts"]]
         contest_precincts = set()
-        [contest_precincts.update(bs["precincts"]) for bs in contest_ballot_styles]
-        for precinct in contest_precincts:
-            if contest["type"] == "ms-either-neither":
-                contests_by_precinct[precinct].append(contest["eitherNeitherContestId"])
-                contests_by_precinct[precinct].append(contest["pickOneContestId"])
-            else:
-                contests_by_precinct[precinct].append(contest["id"])
+        [contest_precincts.update(sys.intern(p) for p in bs["precincts"]) for bs in contest_ballot_styles]
+        for contest in expanded_contests(c):
+            model = contest_model(contest, parties_by_id)
+            contest_id = model.labels[0]
+            contests_by_id[contest_id] = model
+            precincts_by_contest[contest_id] = sorted(contest_precincts)
+            for precinct in contest_precincts:
+                contests_by_precinct[precinct].append(contest_id)
+
+    return {
+        "countyId": sys.intern(election["county"]["id"]),
+        "contestsById": contests_by_id,
+        "contestsByPrecinct": {precinct_id: sorted(contest_ids) for precinct_id, contest_ids in contests_by_precinct.items()},
+        "precinctsByContest": precincts_by_contest
+    }
+
+def discrepancy(kind, message, precinct_id, contest_id=None, option_id=None):
+    return {"type": kind, "precinctId": precinct_id, "contestId": contest_id, "optionId": option_id, "message": message}
 
-    rows_to_write = []
-    for precinct in sorted(precincts, key=lambda precinct: precinct["id"]):
-        precinct_id = precinct["id"]
-        contest_tallies = tallies_by_precinct[precinct_id] if precinct_id in tallies_by_precinct else {}
+def validate_contest_tally(precinct_id, contest_id, contest, contest_tally, discrepancies):
+    option_tallies = contest_tally["tallies"] if "tallies" in contest_tally else {}
+
+    for option_id in option_tallies:
+        if option_id not in contest.tally_keys:
+            discrepancies.append(discrepancy("unknown-option", "option is not in the contest", precinct_id, contest_id, option_id))
+
+    # every ballot accounts for one vote per seat, as a vote, an undervote or an overvote
+    metadata = contest_tally["metadata"] if "metadata" in contest_tally else {}
+    if "ballots" in metadata:
+        votes = sum(option_tallies.values()) + metadata.get("overvotes", 0) + metadata.get("undervotes", 0)
+        expected_votes = metadata["ballots"] * contest.seats
+        if votes != expected_votes:
+            discrepancies.append(discrepancy(
+                "inconsistent-counts",
+                "votes, overvotes and undervotes add up to %d, expected %d for %d ballots" % (votes, expected_votes, metadata["ballots"]),
+                precinct_id, contest_id))
+
+def selected_precinct_ids(index, precinct_ids=None, contest_ids=None):
+    # the precincts with rows to export, in output order
+    contests_by_precinct = index["contestsByPrecinct"]
+    if precinct_ids is not None:
+        return sorted(set(p for p in precinct_ids if p in contests_by_precinct))
+    if contest_ids is not None:
+        precinct_ids = set()
+        for contest_id in contest_ids:
+            precinct_ids.update(index["precinctsByContest"].get(contest_id, []))
+        return sorted(precinct_ids)
+    return sorted(contests_by_precinct)
+
+def check_precincts(index, tallies, discrepancies):
+    for precinct_id in tallies["talliesByPrecinct"]:
+        if precinct_id not in index["contestsByPrecinct"]:
+            discrepancies.append(discrepancy("unknown-precinct", "precinct is not in the election", precinct_id))
+
+def tallies_rows(index, tallies, discrepancies=None, precinct_ids=None, contest_ids=None, ballots_by_contest=None):
+    # yields SEMS rows, as tuples, in output order: by precinct, then contest, then candidate
+    #
+    # precinct_ids and/or contest_ids limit the rows to those precincts and contests.
+    #
+    # if a discrepancies list is passed in, the tallies are checked as the rows are generated
+    # and any problems found are appended to it
+    #
+    # if a ballots_by_contest dict is passed in, the ballots of each contest are added up in it, see add_ballots
+    county_id = index["countyId"]
+    contests_by_id = index["contestsById"]
+    contests_by_precinct = index["contestsByPrecinct"]
+    tallies_by_precinct = tallies["talliesByPrecinct"]
+    selected_contest_ids = set(contest_ids) if contest_ids is not None else None
+
+    # unknown precincts and contests can only be spotted when exporting everything
+    if discrepancies is not None and precinct_ids is None and contest_ids is None:
+        check_precincts(index, tallies, discrepancies)
+
+    empty = {}
+    for precinct_id in selected_precinct_ids(index, precinct_ids, contest_ids):
+        contest_tallies = tallies_by_precinct.get(precinct_id, empty)
         contests_to_check = contests_by_precinct[precinct_id]
-        for contest_id in sorted(contests_to_check):
-            contest_tally = contest_tallies[contest_id] if contest_id in contest_tallies else {}
-            contest = find_contest(contests, contest_id)
-            
-            contest_party_id = contest["partyId"] if "partyId" in contest else None
-            contest_party = [p for p in parties if p["id"] == contest_party_id][0] if contest_party_id is not None else None
-
-            rows_for_contest = []
-            base_row_data = [
-                county_id,
-                precinct_id,
-                contest_id,
-                contest["title"].replace("\n", "\\n"),
-                contest_party_id or "0",
-                contest_party["abbrev"] if contest_party is not None else "NP"
-            ]
-            
-            # Add undervote and overvote row from metadata
+
+        if discrepancies is not None and contest_ids is None:
+            for contest_id in contest_tallies:
+                if contest_id not in contests_to_check:
+                    discrepancies.append(discrepancy("unknown-contest", "contest is not on the ballot in this precinct", precinct_id, contest_id))
+
+        for contest_id in contests_to_check:
+            if selected_contest_ids is not None and contest_id not in selected_contest_ids:
+                continue
+
+            contest_tally = contest_tallies.get(contest_id, empty)
+            contest = contests_by_id[contest_id]
+
+            if discrepancies is not None:
+                validate_contest_tally(precinct_id, contest_id, contest, contest_tally, discrepancies)
+            if ballots_by_contest is not None:
+                add_ballots(ballots_by_contest, contest_id, *contest_tally_ballots(contest_tally, contest.seats))
+
+            option_tallies = contest_tally.get("tallies", empty)
+            metadata = contest_tally.get("metadata", empty)
+            for labels, tally_key, in_metadata in contest.option_rows:
+                yield (county_id, precinct_id, *labels, (metadata if in_metadata else option_tallies).get(tally_key, 0))
+
+#
+# SQL-backed export
+#
+# The election is saved as tables of identifiers and labels: every contest on the ballot in every precinct,
+# and every option of every contest, including the overvote, undervote and write-in rows. Each option has
+# the key it's counted under in the tallies. Tallies, and CVRs tallied with a group by, are loaded into a
+# temporary table keyed the same way, and a single join produces the SEMS rows.
+#
+
+ELECTION_MODEL_SQL = [
+    "create table vx_county (county_id varchar(500))",
+    """create table vx_contests (contest_id varchar(500) primary key, title varchar(500), party_id varchar(500),
+       party_abbrev varchar(500), seats integer)""",
+    """create table vx_options (contest_id varchar(500), option_id varchar(500), name varchar(500),
+       party_id varchar(500), party_abbrev varchar(500), tally_key varchar(500))""",
+    "create table vx_contest_precincts (precinct_id varchar(500), contest_id varchar(500))",
+    "create index vx_options_contest on vx_options (contest_id, option_id)",
+    "create index vx_contest_precincts_precinct on vx_contest_precincts (precinct_id, contest_id)",
+    "create index vx_contest_precincts_contest on vx_contest_precincts (contest_id)"
+]
+
+TALLIES_TABLE_SQL = "create temp table if not exists tallies (precinct_id varchar(500), contest_id varchar(500), tally_key varchar(500), count integer)"
+
+OVERVOTES_KEY = "__overvotes"
+UNDERVOTES_KEY = "__undervotes"
+# ballot counts go in the tallies table too, under keys no option has, see contest_tally_ballots
+BALLOTS_KEY = "__ballots"
+DERIVED_BALLOTS_KEY = "__derived-ballots"
+
+# write-ins show up in CVRs under a few different ids
+WRITE_IN_PREFIXES = ("__write-in", "__writein", "write-in", "writein")
+
+def save_election_model(db, election):
+    index = index_election(election)
+    metadata_tally_keys = {"overvotes": OVERVOTES_KEY, "undervotes": UNDERVOTES_KEY}
+
+    c = db.cursor()
+    for sql in ELECTION_MODEL_SQL:
+        c.execute(sql)
+
+    c.execute("insert into vx_county values (?)", [index["countyId"]])
+    for contest_id, contest in index["contestsById"].items():
+        c.execute("insert into vx_contests values (?, ?, ?, ?, ?)", list(contest.labels) + [contest.seats])
+        c.executemany("insert into vx_options values (?, ?, ?, ?, ?, ?)", [
+            [contest_id] + list(row.option_labels) + [metadata_tally_keys[row.tally_key] if row.in_metadata else row.tally_key]
+            for row in contest.option_rows])
+        c.executemany("insert into vx_contest_precincts values (?, ?)", [[precinct_id, contest_id] for precinct_id in index["precinctsByContest"][contest_id]])
+
+    db.commit()
+
+def create_election_database(election, db_path):
+    db = sqlite3.connect(db_path)
+    save_election_model(db, election)
+    return db
+
+def load_tallies(db, tallies, precinct_ids=None, contest_ids=None):
+    # precinct_ids and/or contest_ids limit the tallies loaded to those precincts and contests
+    c = db.cursor()
+    c.execute(TALLIES_TABLE_SQL)
+    seats_by_contest = dict(c.execute("select contest_id, seats from vx_contests").fetchall())
+    tallies_by_precinct = tallies["talliesByPrecinct"]
+    selected_contest_ids = set(contest_ids) if contest_ids is not None else None
+    for precinct_id in (tallies_by_precinct if precinct_ids is None else [p for p in precinct_ids if p in tallies_by_precinct]):
+        for contest_id, contest_tally in tallies_by_precinct[precinct_id].items():
+            if selected_contest_ids is not None and contest_id not in selected_contest_ids:
+                continue
             metadata = contest_tally["metadata"] if "metadata" in contest_tally else {}
-            overvotes_row = base_row_data.copy()
-            overvotes_row.extend([
-                OVERVOTE_CANDIDATE["id"],
-                OVERVOTE_CANDIDATE["name"],
-                "0",
-                "NP",
-                metadata["overvotes"] if "overvotes" in metadata else 0
-            ])
-            rows_for_contest.append(overvotes_row)
-            undervotes_row = base_row_data.copy()
-            undervotes_row.extend([
-                UNDERVOTE_CANDIDATE["id"],
-                UNDERVOTE_CANDIDATE["name"],
-                "0",
-                "NP",
-                metadata["undervotes"] if "undervotes" in metadata else 0
-            ])
-            rows_for_contest.append(undervotes_row)
-
-            option_tallies = contest_tally["tallies"] if "tallies" in contest_tally else {}
-            if contest["type"] == "candidate":
-                options = contest["candidates"].copy()
-                if contest["allowWriteIns"]:
-                    options.append(WRITEIN_CANDIDATE)
-                for option in options:
-                    if option == WRITEIN_CANDIDATE:
-                        count = option_tallies[INTERNAL_WRITE_IN_ID] if INTERNAL_WRITE_IN_ID in option_tallies else 0
-                    else:
-                        count = option_tallies[option["id"]] if option["id"] in option_tallies else 0
-
-                    option_party_id = option["partyId"] if "partyId" in option else None
-                    option_party = [p for p in parties if p["id"] == option_party_id][0] if option_party_id is not None else None
-                    candidate_row = base_row_data.copy()
-                    candidate_row.extend([
-                        option["id"],
-                        option.get("name", option.get("label")),
-                        option_party_id or "0",
-                        option_party["abbrev"] if option_party is not None else "NP",
-                        count
-                    ])
-                    rows_for_contest.append(candidate_row)
-
-            elif contest["type"] == "yesno":
-                # get ids for yes option and no option
-                yes_option = contest["yesOption"]
-                no_option = contest["noOption"]
-                yes_count = option_tallies["yes"] if "yes" in option_tallies else 0
-                no_count = option_tallies["no"] if "no" in option_tallies else 0
-                yes_row = base_row_data.copy()
-                yes_row.extend([
-                    yes_option["id"],
-                    yes_option.get("name", yes_option.get("label")),
-                    "0",
-                    "NP",
-                    yes_count
-                ])
-                rows_for_contest.append(yes_row)
-
-                no_row = base_row_data.copy()
-                no_row.extend([
-                    no_option["id"],
-                    no_option.get("name", no_option.get("label")),
-                    "0",
-                    "NP",
-                    no_count
-                ])
-                rows_for_contest.append(no_row)
-            # Append rows sorted by candidate ID
-            for row in sorted(rows_for_contest, key=lambda row: row[6]):
-                rows_to_write.append(row)
+            counts = list((contest_tally["tallies"] if "tallies" in contest_tally else {}).items())
+            counts += [(OVERVOTES_KEY, metadata.get("overvotes", 0)), (UNDERVOTES_KEY, metadata.get("undervotes", 0))]
+            counts += zip([BALLOTS_KEY, DERIVED_BALLOTS_KEY], contest_tally_ballots(contest_tally, seats_by_contest.get(contest_id, 1)))
+            c.executemany("insert into tallies values (?, ?, ?, ?)", [[precinct_id, contest_id, key, count] for key, count in counts])
+
+def load_cvrs(db, cvrs):
+    # each CVR's votes go into a temporary table, and are tallied into the tallies table with a group by:
+    # a contest with more votes than seats counts as that many overvotes, fewer is counted as undervotes
+    c = db.cursor()
+    c.execute(TALLIES_TABLE_SQL)
+    c.execute("create temp table cvr_contests (cvr_number integer, precinct_id varchar(500), contest_id varchar(500), votes integer)")
+    c.execute("create temp table cvr_votes (cvr_number integer, contest_id varchar(500), tally_key varchar(500))")
+
+    for cvr_number, cvr in enumerate(cvrs):
+        precinct_id = cvr["_precinctId"]
+        for contest_id, votes in cvr.items():
+            if contest_id.startswith("_"):
+                continue
+            c.execute("insert into cvr_contests values (?, ?, ?, ?)", [cvr_number, precinct_id, contest_id, len(votes)])
+            c.executemany("insert into cvr_votes values (?, ?, ?)", [
+                [cvr_number, contest_id, INTERNAL_WRITE_IN_ID if vote.startswith(WRITE_IN_PREFIXES) else vote] for vote in votes])
+
+    c.execute("""
+    insert into tallies
+    select cvr_contests.precinct_id, cvr_contests.contest_id, cvr_votes.tally_key, count(*)
+    from cvr_contests, cvr_votes, vx_contests
+    where
+    cvr_contests.cvr_number = cvr_votes.cvr_number and cvr_contests.contest_id = cvr_votes.contest_id and
+    cvr_contests.contest_id = vx_contests.contest_id and cvr_contests.votes <= vx_contests.seats
+    group by cvr_contests.precinct_id, cvr_contests.contest_id, cvr_votes.tally_key""")
+
+    c.execute("""
+    insert into tallies
+    select cvr_contests.precinct_id, cvr_contests.contest_id, ?,
+    sum(case when cvr_contests.votes > vx_contests.seats then vx_contests.seats else 0 end)
+    from cvr_contests, vx_contests
+    where cvr_contests.contest_id = vx_contests.contest_id
+    group by cvr_contests.precinct_id, cvr_contests.contest_id
+    union all
+    select cvr_contests.precinct_id, cvr_contests.contest_id, ?,
+    sum(case when cvr_contests.votes <= vx_contests.seats then vx_contests.seats - cvr_contests.votes else 0 end)
+    from cvr_contests, vx_contests
+    where cvr_contests.contest_id = vx_contests.contest_id
+    group by cvr_contests.precinct_id, cvr_contests.contest_id""", [OVERVOTES_KEY, UNDERVOTES_KEY])
+
+    # every CVR with a contest is a ballot of that contest
+    c.execute("""
+    insert into tallies
+    select precinct_id, contest_id, ?, count(*) from cvr_contests group by precinct_id, contest_id""", [BALLOTS_KEY])
+
+    c.execute("drop table cvr_contests")
+    c.execute("drop table cvr_votes")
+
+def selection_conditions(precinct_ids=None, contest_ids=None):
+    # the conditions on vx_contest_precincts for the precincts and contests to export, and their parameters
+    conditions = []
+    params = []
+    for column, values in [("vx_contest_precincts.precinct_id", precinct_ids), ("vx_contest_precincts.contest_id", contest_ids)]:
+        if values is not None:
+            conditions.append("%s in (%s)" % (column, ",".join(["?"] * len(values))))
+            params += list(values)
+    return conditions, params
+
+def sql_rows(db, precinct_ids=None, contest_ids=None):
+    # same rows, in the same order, as tallies_rows
+    c = db.cursor()
+    c.execute(TALLIES_TABLE_SQL)
+    c.execute("create index if not exists temp.tallies_key on tallies (precinct_id, contest_id, tally_key)")
+    conditions, params = selection_conditions(precinct_ids, contest_ids)
+
+    sql = """
+    select
+    vx_county.county_id, vx_contest_precincts.precinct_id, vx_contests.contest_id, vx_contests.title,
+    vx_contests.party_id, vx_contests.party_abbrev, vx_options.option_id, vx_options.name,
+    vx_options.party_id, vx_options.party_abbrev, coalesce(sum(tallies.count), 0)
+    from vx_county, vx_contest_precincts
+    join vx_contests on vx_contests.contest_id = vx_contest_precincts.contest_id
+    join vx_options on vx_options.contest_id = vx_contests.contest_id
+    left join tallies on
+    tallies.precinct_id = vx_contest_precincts.precinct_id and tallies.contest_id = vx_contests.contest_id and
+    tallies.tally_key = vx_options.tally_key
+    %s
+    group by vx_contest_precincts.precinct_id, vx_contests.contest_id, vx_options.option_id
+    order by vx_contest_precincts.precinct_id, vx_contests.contest_id, vx_options.option_id""" % (
+        "where " + " and ".join(conditions) if conditions else "")
+
+    for row in c.execute(sql, params):
+        yield list(row)
 
+def sql_ballots(db, ballots_by_contest, precinct_ids=None, contest_ids=None):
+    # adds the ballots of the contests on the ballot in the precincts to export into ballots_by_contest
+    c = db.cursor()
+    c.execute(TALLIES_TABLE_SQL)
+    conditions, params = selection_conditions(precinct_ids, contest_ids)
+    sql = """
+    select tallies.contest_id, sum(case when tallies.tally_key = ? then tallies.count else 0 end),
+    sum(case when tallies.tally_key = ? then tallies.count else 0 end)
+    from vx_contest_precincts
+    join tallies on tallies.precinct_id = vx_contest_precincts.precinct_id and tallies.contest_id = vx_contest_precincts.contest_id
+    where tallies.tally_key in (?, ?) %s
+    group by tallies.contest_id""" % "".join(" and " + condition for condition in conditions)
+    for contest_id, counted, derived in c.execute(sql, [BALLOTS_KEY, DERIVED_BALLOTS_KEY, BALLOTS_KEY, DERIVED_BALLOTS_KEY] + params):
+        add_ballots(ballots_by_contest, contest_id, counted, derived)
 
+def closing_chunks(chunks, db):
+    # the chunks, closing the database once they have all been read, or the reader stops
+    try:
+        yield from chunks
+    finally:
+        db.close()
+
+def generate_sems_results_sql(db_path, vx_results_file_paths=None, cvr_file_paths=None, sems_results_file_path=None,
+                              precinct_ids=None, contest_ids=None, summary=None, skipped_cvrs=None, include_test_ballots=False):
+    # tallies and CVRs are added together
+    #
+    # test ballots (unless include_test_ballots) and ballots found more than once in the CVRs aren't counted,
+    # if a skipped_cvrs list is passed in they are appended to it, see unique_cvrs
+    db = sqlite3.connect(db_path)
+    try:
+        for vx_results_file_path in vx_results_file_paths or []:
+            load_tallies(db, loaded_file("tallies", vx_results_file_path, json.loads), precinct_ids, contest_ids)
+        if cvr_file_paths:
+            load_cvrs(db, unique_cvrs(cvr_file_paths, skipped_cvrs if skipped_cvrs is not None else [], include_test_ballots))
+
+        other_results = other_sems_results(sems_results_file_path, precinct_ids, contest_ids)
+        rows = sql_rows(db, precinct_ids, contest_ids)
+        if other_results is not None:
+            rows = merged_with(rows, other_results)
+        if summary is not None:
+            summary["countyId"] = db.execute("select county_id from vx_county").fetchone()[0]
+            ballots_by_contest = sems_results_ballots(other_results, dict(db.execute("select contest_id, seats from vx_contests").fetchall()))
+            sql_ballots(db, ballots_by_contest, precinct_ids, contest_ids)
+            rows = summarized_rows(rows, summary, ballots_by_contest)
+    except Exception:
+        db.close()
+        raise
+    return closing_chunks(sems_chunks(rows), db)
+
+def sems_chunks(rows, chunk_rows=1000):
+    # SEMS needs a trailing comma on every row, which the line terminator takes care of
     sems_io = io.StringIO()
-    for row in rows_to_write:
-        # a whole rigamarole because SEMS needs a trailing comma
-        row_bytesio = io.StringIO()
-        sems_row_writer = csv.writer(row_bytesio, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
+    sems_row_writer = csv.writer(sems_io, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL, lineterminator=",\r\n")
+    for row_number, row in enumerate(rows, 1):
         sems_row_writer.writerow(row)
-    
-        sems_io.write(row_bytesio.getvalue().strip('\r\n'))
-        sems_io.write(",\r\n")
+        if row_number % chunk_rows == 0:
+            yield sems_io.getvalue()
+            sems_io.seek(0)
+            sems_io.truncate()
+
+    # an empty chunk would end a chunked HTTP response early
+    if sems_io.tell():
+        yield sems_io.getvalue()
+
+def sems_row_key(row):
+    # county_id, precinct_id, contest_id, candidate_id
+    return (row[0], row[1], row[2], row[6])
+
+def parse_sems_results(lines):
+    # index SEMS rows by sems_row_key, with the count as an integer
+    results = {}
+    for row in csv.reader(lines, delimiter=',', quotechar='"'):
+        # skip blank lines, and drop the empty field that follows SEMS' trailing comma
+        if not row:
+            continue
+        row = row[:10] + [int(row[10])]
+        key = sems_row_key(row)
+        if key in results:
+            results[key][10] += row[10]
+        else:
+            results[key] = row
+    return results
+
+def read_sems_results(sems_results_file_path):
+    with open(sems_results_file_path, "r", newline="") as sems_results_file:
+        return parse_sems_results(sems_results_file)
+
+def merge_sems_results(*all_results):
+    # sums counts by county/precinct/contest/candidate, labels come from the first results that have the row
+    merged = {}
+    for results in all_results:
+        for key, row in results.items():
+            if key in merged:
+                merged[key][10] += row[10]
+            else:
+                merged[key] = list(row)
+    return merged
+
+def sorted_sems_rows(results):
+    # same order as tallies_rows: by precinct, then contest, then candidate
+    return [results[key] for key in sorted(results)]
+
+def selected_results(results, precinct_ids=None, contest_ids=None):
+    if precinct_ids is None and contest_ids is None:
+        return results
+    selected_precinct_ids = set(precinct_ids) if precinct_ids is not None else None
+    selected_contest_ids = set(contest_ids) if contest_ids is not None else None
+    return {key: row for key, row in results.items()
+            if (selected_precinct_ids is None or key[1] in selected_precinct_ids)
+            and (selected_contest_ids is None or key[2] in selected_contest_ids)}
+
+def other_sems_results(sems_results_file_path, precinct_ids=None, contest_ids=None):
+    # results from another system, e.g. absentee results, to add into the Vx results, None if there are none
+    if not sems_results_file_path:
+        return None
+    return selected_results(read_sems_results(sems_results_file_path), precinct_ids, contest_ids)
+
+def merged_with(rows, other_results):
+    vx_results = {sems_row_key(row): row for row in rows}
+    return sorted_sems_rows(merge_sems_results(vx_results, other_results))
+
+def contest_seats(index):
+    return {contest_id: contest.seats for contest_id, contest in index["contestsById"].items()}
+
+#
+# Parallel export
+#
+# Precincts don't depend on one another, so for big elections the precincts to export are split into
+# contiguous batches, rendered in a pool of processes, and put back together in order, which gives the
+# same bytes as rendering them one after the other. The pool is kept from one export to the next, unless
+# one of its workers dies, killed for running out of memory say, which breaks the pool for good.
+#
+
+PROCESS_POOL = {"lock": threading.Lock(), "pool": None, "workers": 0}
+
+def process_pool(workers):
+    # the pool is only replaced when the number of workers changes, which waits for the work already
+    # submitted to the old one. Call with the lock held, see pool_results.
+    if PROCESS_POOL["workers"] != workers:
+        if PROCESS_POOL["pool"] is not None:
+            PROCESS_POOL["pool"].shutdown()
+        PROCESS_POOL["pool"] = ProcessPoolExecutor(max_workers=workers)
+        PROCESS_POOL["workers"] = workers
+    return PROCESS_POOL["pool"]
+
+def drop_pool(pool):
+    # a broken pool is dropped, so the next export gets a new one
+    with PROCESS_POOL["lock"]:
+        if PROCESS_POOL["pool"] is pool:
+            PROCESS_POOL["pool"] = None
+            PROCESS_POOL["workers"] = 0
+    pool.shutdown(wait=False)
+
+def pool_results(workers, func, items):
+    # func of each item, in order, computed in the pool. A broken pool is replaced, and if none of the
+    # results were out yet, the items are submitted once more to the new one.
+    for attempt in range(2):
+        returned = False
+        try:
+            # map submits everything right away, so holding the lock while it does keeps another
+            # export from replacing the pool in between
+            with PROCESS_POOL["lock"]:
+                pool = process_pool(workers)
+                results = pool.map(func, items)
+            for result in results:
+                returned = True
+                yield result
+            return
+        except BrokenProcessPool:
+            drop_pool(pool)
+            if returned or attempt == 1:
+                raise
+
+def render_precincts(batch):
+    # the SEMS text of a batch of precincts, along with its discrepancies and totals if asked for
+    index, tallies, other_results, precinct_ids, contest_ids, validate, add_up = batch
+    discrepancies = [] if validate else None
+    totals_by_contest = {} if add_up else None
+    ballots_by_contest = {} if add_up else None
+
+    rows = tallies_rows(index, tallies, discrepancies, precinct_ids, contest_ids, ballots_by_contest)
+    if other_results is not None:
+        rows = merged_with(rows, other_results)
+    if add_up:
+        rows = totaled_rows(rows, totals_by_contest)
+    return "".join(sems_chunks(rows)), discrepancies, totals_by_contest, ballots_by_contest
+
+def parallel_sems_chunks(index, tallies, workers, other_results=None, discrepancies=None, precinct_ids=None, contest_ids=None,
+                         summary=None):
+    # same as sems_chunks(merged_with(tallies_rows(...), other_results)), one chunk per batch of precincts
+    if discrepancies is not None and precinct_ids is None and contest_ids is None:
+        check_precincts(index, tallies, discrepancies)
+
+    # a few batches per worker, so one slow batch doesn't hold up the others
+    precinct_ids_to_render = selected_precinct_ids(index, precinct_ids, contest_ids)
+    batch_count = max(1, min(workers * 4, len(precinct_ids_to_render)))
+    precinct_batches = [precinct_ids_to_render[i * len(precinct_ids_to_render) // batch_count:(i + 1) * len(precinct_ids_to_render) // batch_count]
+                        for i in range(batch_count)]
+
+    # the other results go with the batch whose precincts they sort among
+    other_batches = [None] * batch_count
+    if other_results is not None:
+        other_batches = [{} for _ in range(batch_count)]
+        # rows sort by county before precinct, and another county's rows can be merged in too
+        batch_starts = [(index["countyId"], precinct_batch[0]) for precinct_batch in precinct_batches[1:]]
+        for key, row in other_results.items():
+            other_batches[bisect.bisect_right(batch_starts, key[:2])][key] = row
+
+    tallies_by_precinct = tallies["talliesByPrecinct"]
+    batches = [(index, {"talliesByPrecinct": {p: tallies_by_precinct[p] for p in precinct_batch if p in tallies_by_precinct}},
+                other_batch, precinct_batch, contest_ids, discrepancies is not None, summary is not None)
+               for precinct_batch, other_batch in zip(precinct_batches, other_batches)]
+
+    totals_by_contest = {}
+    ballots_by_contest = sems_results_ballots(other_results, contest_seats(index)) if summary is not None else None
+    for text, batch_discrepancies, batch_totals, batch_ballots in pool_results(workers, render_precincts, batches):
+        if discrepancies is not None:
+            discrepancies.extend(batch_discrepancies)
+        if summary is not None:
+            add_totals(totals_by_contest, batch_totals)
+            for contest_id, (counted, derived) in batch_ballots.items():
+                add_ballots(ballots_by_contest, contest_id, counted, derived)
+        # an empty chunk would end a chunked HTTP response early
+        if text:
+            yield text
+
+    if summary is not None:
+        summary["contests"] = summary_contests(totals_by_contest, ballots_by_contest)
+
+def totaled_rows(rows, totals_by_contest):
+    # passes the rows through while adding them up per contest and candidate into totals_by_contest
+    for row in rows:
+        yield row
+        contest_totals = totals_by_contest.get(row[2])
+        if contest_totals is None:
+            contest_totals = totals_by_contest[row[2]] = (row[3], row[4], row[5], {})
+        option_totals = contest_totals[3]
+        if row[6] in option_totals:
+            option_totals[row[6]][3] += row[10]
+        else:
+            option_totals[row[6]] = [row[7], row[8], row[9], row[10]]
+
+def add_totals(totals_by_contest, more_totals_by_contest):
+    for contest_id, (title, party_id, party_abbrev, more_option_totals) in more_totals_by_contest.items():
+        contest_totals = totals_by_contest.setdefault(contest_id, (title, party_id, party_abbrev, {}))
+        for option_id, option in more_option_totals.items():
+            if option_id in contest_totals[3]:
+                contest_totals[3][option_id][3] += option[3]
+            else:
+                contest_totals[3][option_id] = option
+
+#
+# Ballots
+#
+# The ballots of a contest are the ballots counted in the Vx tallies' metadata, or the CVRs with the contest.
+# SEMS results don't have them, and neither do tallies without a ballot count, so there they are worked out
+# from the counts: every ballot accounts for one vote per seat, as a vote, an overvote or an undervote. Those
+# are kept apart as derived ballots, as they are only right if the counts add up.
+#
+# ballots_by_contest maps each contest id to [counted ballots, derived ballots].
+#
+
+def add_ballots(ballots_by_contest, contest_id, counted, derived):
+    ballots = ballots_by_contest.setdefault(contest_id, [0, 0])
+    ballots[0] += counted
+    ballots[1] += derived
+
+def contest_tally_ballots(contest_tally, seats):
+    # (counted, derived) ballots of a contest's tally
+    metadata = contest_tally["metadata"] if "metadata" in contest_tally else {}
+    if "ballots" in metadata:
+        return metadata["ballots"], 0
+    votes = sum((contest_tally["tallies"] if "tallies" in contest_tally else {}).values())
+    return 0, (votes + metadata.get("overvotes", 0) + metadata.get("undervotes", 0)) // seats
+
+def sems_results_ballots(results, seats_by_contest):
+    # the derived ballots of SEMS results, worked out per precinct, as a new ballots_by_contest
+    votes_by_precinct_contest = {}
+    for (_, precinct_id, contest_id, _), row in (results or {}).items():
+        votes_by_precinct_contest[(precinct_id, contest_id)] = votes_by_precinct_contest.get((precinct_id, contest_id), 0) + row[10]
+
+    ballots_by_contest = {}
+    for (_, contest_id), votes in votes_by_precinct_contest.items():
+        add_ballots(ballots_by_contest, contest_id, 0, votes // seats_by_contest.get(contest_id, 1))
+    return ballots_by_contest
+
+def summarized_rows(rows, summary, ballots_by_contest):
+    # passes the rows through while adding them up into county-wide totals per contest and candidate,
+    # which are put in the summary dict once the rows are all out, along with the ballots of each contest,
+    # added up into ballots_by_contest meanwhile
+    totals_by_contest = {}
+    yield from totaled_rows(rows, totals_by_contest)
+    summary["contests"] = summary_contests(totals_by_contest, ballots_by_contest)
+
+def summary_contests(totals_by_contest, ballots_by_contest):
+    contests = []
+    for contest_id in sorted(totals_by_contest):
+        title, party_id, party_abbrev, option_totals = totals_by_contest[contest_id]
+        overvotes = option_totals.pop(OVERVOTE_CANDIDATE["id"], [0, 0, 0, 0])[3]
+        undervotes = option_totals.pop(UNDERVOTE_CANDIDATE["id"], [0, 0, 0, 0])[3]
+        votes = sum(option[3] for option in option_totals.values())
+        counted_ballots, derived_ballots = ballots_by_contest.get(contest_id, [0, 0])
+        contests.append({
+            "contestId": contest_id,
+            "title": title,
+            "partyId": party_id,
+            "partyAbbrev": party_abbrev,
+            "ballots": counted_ballots + derived_ballots,
+            "derivedBallots": derived_ballots,
+            "votes": votes,
+            "overvotes": overvotes,
+            "undervotes": undervotes,
+            "options": [{"candidateId": option_id, "name": name, "partyId": option_party_id, "partyAbbrev": option_party_abbrev, "votes": count}
+                        for option_id, (name, option_party_id, option_party_abbrev, count) in sorted(option_totals.items())]
+        })
+    return contests
+
+def summary_csv(summary):
+    # one row per contest and candidate, with the contest's ballots, overvotes and undervotes as candidates
+    summary_io = io.StringIO()
+    summary_writer = csv.writer(summary_io, lineterminator="\r\n")
+    summary_writer.writerow(["contest_id", "contest_title", "party_id", "candidate_id", "candidate_name", "candidate_party_id", "count"])
+    for contest in summary["contests"]:
+        contest_fields = [contest["contestId"], contest["title"], contest["partyId"]]
+        for candidate_id, name, key in [("", "Ballots", "ballots"), (OVERVOTE_CANDIDATE["id"], OVERVOTE_CANDIDATE["name"], "overvotes"),
+                                        (UNDERVOTE_CANDIDATE["id"], UNDERVOTE_CANDIDATE["name"], "undervotes")]:
+            summary_writer.writerow(contest_fields + [candidate_id, name, "0", contest[key]])
+        for option in contest["options"]:
+            summary_writer.writerow(contest_fields + [option["candidateId"], option["name"], option["partyId"], option["votes"]])
+    return summary_io.getvalue()
+
+# the last election index and tallies read, with the path, size and modification time of the file they were
+# read from, so that exporting a few precincts or contests at a time doesn't read, parse and index the whole
+# election every time. Uploads and outputs replace files, which changes the modification time.
+LOADED_FILES = {"election": (None, None), "tallies": (None, None)}
+
+def loaded_file(kind, file_path, load):
+    # load(content) for the file, or what it returned last time if the file hasn't changed since
+    key = (file_path,) + file_signature(file_path)
+    loaded_key, loaded = LOADED_FILES[kind]
+    if loaded_key != key:
+        loaded = load(open(file_path, "rb").read())
+        LOADED_FILES[kind] = (key, loaded)
+    return loaded
+
+def generate_sems_results(election_file_path, vx_results_file_path, sems_results_file_path=None, discrepancies=None,
+                          precinct_ids=None, contest_ids=None, summary=None, workers=None):
+    # if a summary dict is passed in, the county-wide totals of the rows are added to it, see summarized_rows
+    #
+    # with workers, precincts are rendered in that many processes, see parallel_sems_chunks
+    index = loaded_file("election", election_file_path, lambda content: index_election(json.loads(content)))
+    tallies = loaded_file("tallies", vx_results_file_path, json.loads)
+    if summary is not None:
+        summary["countyId"] = index["countyId"]
+
+    other_results = other_sems_results(sems_results_file_path, precinct_ids, contest_ids)
+    if workers:
+        return parallel_sems_chunks(index, tallies, workers, other_results, discrepancies, precinct_ids, contest_ids, summary)
+
+    ballots_by_contest = sems_results_ballots(other_results, contest_seats(index)) if summary is not None else None
+    rows = tallies_rows(index, tallies, discrepancies, precinct_ids, contest_ids, ballots_by_contest)
+    if other_results is not None:
+        rows = merged_with(rows, other_results)
+    if summary is not None:
+        rows = summarized_rows(rows, summary, ballots_by_contest)
+    return sems_chunks(rows)
 
-    return sems_io.getvalue()
+def process_tallies_file(election_file_path, vx_results_file_path, sems_results_file_path=None, discrepancies=None,
+                         precinct_ids=None, contest_ids=None, summary=None, workers=None):
+    return "".join(generate_sems_results(election_file_path, vx_results_file_path, sems_results_file_path, discrepancies,
+                                         precinct_ids, contest_ids, summary, workers))
 
 if __name__ == "__main__": # pragma: no cover this is the main
-    sems_value = process_tallies_file(sys.argv[1], sys.argv[2])
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    discrepancies = [] if "--validate" in sys.argv else None
+    summary_path = [a.split("=", 1)[1] for a in sys.argv[1:] if a.startswith("--summary=")]
+    summary = {} if summary_path else None
+    profile_path = [a.split("=", 1)[1] for a in sys.argv[1:] if a.startswith("--profile=")]
+    if profile_path:
+        sems_value, profile = profile_call(process_tallies_file, *args[:3], discrepancies=discrepancies, summary=summary)
+        save_profile(profile, profile_path[0])
+    else:
+        sems_value = process_tallies_file(*args[:3], discrepancies=discrepancies, summary=summary)
     print(sems_value)
+    if summary_path:
+        with open(summary_path[0], "w", newline="") as summary_file:
+            summary_file.write(summary_csv(summary) if summary_path[0].endswith(".csv") else json.dumps(summary, indent=2))
+    if discrepancies:
+        for d in discrepancies:
+            print("precinct %s, contest %s, option %s: %s" % (d["precinctId"], d["contestId"], d["optionId"], d["message"]), file=sys.stderr)
+        sys.exit(1)
@@ -1,17 +1,30 @@
 
-import json, os, tempfile
+import json, mimetypes, os
 
-from flask import Flask, send_from_directory, send_file, request
+from flask import Flask, Response, send_from_directory, send_file, request, stream_with_context
 from werkzeug.utils import secure_filename
 
 from . import SEMSinput
 from . import SEMSoutput
+from . import profiling
+from . import events
+from .outputs import TMP_PREFIX, OUTPUT_HASHES, temporary_file, tee_output, save_output, output_hash, discard_output_hash
 
 # directory for all files (from env variable first)
 FILES_DIR = os.getenv("MODULE_SEMS_CONVERTER_WORKSPACE") or os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'election_files')
 
+def export_workers(value):
+    # the number of processes to render tallies exports in, 0 for none
+    workers = int(value or 0)
+    if workers < 0:
+        raise ValueError("MODULE_SEMS_CONVERTER_WORKERS must be 0 or more, not %d" % workers)
+    return workers
+
 app = Flask(__name__)
 
+# exports are rendered in a pool of this many processes, unless the request asks for parallel=false
+app.config['EXPORT_WORKERS'] = export_workers(os.getenv("MODULE_SEMS_CONVERTER_WORKERS"))
+
 # paths
 ELECTION_FILES = {
     "inputFiles": [
@@ -19,7 +32,10 @@ ELECTION_FILES = {
         {"name": "SEMS candidate mapping file", "path": None}
     ],
     "outputFiles": [
-        {"name": "Vx Election Definition", "path": None}
+        {"name": "Vx Election Definition", "path": None},
+        {"name": "Vx Election Database", "path": None},
+        {"name": "Election Conversion Profile", "path": None},
+        {"name": "Election Conversion Profile Stacks", "path": None}
     ]
 }
 
@@ -36,19 +52,66 @@ RESULTS_FILES = {
 RESULT_TALLIES_FILES = {
     "inputFiles": [
         {"name": "Vx Election Definition", "path": None},
-        {"name": "Vx Tallies", "path": None}
+        {"name": "Vx Tallies", "path": None},
+        {"name": "SEMS Results to merge", "path": None, "optional": True},
+        {"name": "Vx Election Database", "path": None, "optional": True}
     ],
     "outputFiles": [
-        {"name": "SEMS Results", "path": None}
+        {"name": "SEMS Results", "path": None},
+        {"name": "SEMS Results Summary", "path": None},
+        {"name": "SEMS Results Summary CSV", "path": None},
+        {"name": "Tallies Conversion Profile", "path": None},
+        {"name": "Tallies Conversion Profile Stacks", "path": None}
     ]
 }
 
 
+# the last election conversion, to convert revised SEMS files incrementally
+ELECTION_CONVERSION = {"previous": None}
+
 def find_by_name(lst_of_obj, name):
     for obj in lst_of_obj:
         if obj['name'] == name:
             return obj
 
+def flag(request, name):
+    return request.values.get(name, "").lower() in ("1", "true", "yes")
+
+def send_output(request, the_path):
+    # only send_file arguments that Flask 1.1 (as locked in Pipfile.lock) shares with later versions,
+    # the ETag is set and checked against If-None-Match here, answering with a 304 when it matches
+    etag = output_hash(the_path)
+    mimetype = mimetypes.guess_type(the_path)[0] or 'application/octet-stream'
+    if request.accept_encodings['gzip']:
+        # the gzip variant is a different representation, so it gets its own ETag
+        response = send_file(the_path + '.gz', mimetype=mimetype, conditional=False)
+        response.headers['Content-Encoding'] = 'gzip'
+        etag += '-gzip'
+    else:
+        response = send_file(the_path, mimetype=mimetype, conditional=False)
+    response.set_etag(etag)
+    # outputs change in place, so clients check the ETag every time rather than caching them for a while
+    response.cache_control.max_age = 0
+    response.headers.set('Content-Disposition', 'inline', filename=os.path.basename(the_path))
+    response.vary.add('Accept-Encoding')
+    return response.make_conditional(request)
+
+def profile_requested(request):
+    return flag(request, 'profile') or request.headers.get('X-Profile', "").lower() in ("1", "true", "yes")
+
+def run_profiled(request, file_list, profile_name, process):
+    # with profile=true, or an X-Profile: true header, the conversion runs under the profiler, and the profile
+    # is saved as two outputs: <profile_name> in pstats format and <profile_name> Stacks as collapsed stacks
+    if not profile_requested(request):
+        return process()
+
+    result, (stats, stacks) = profiling.profile_call(process)
+    for name, content in [(profile_name, stats), (profile_name + ' Stacks', stacks)]:
+        the_path = os.path.join(FILES_DIR, name)
+        save_output(the_path, content)
+        find_by_name(file_list['outputFiles'], name)['path'] = the_path
+    return result
+
 @app.route('/convert/election/files', methods=["GET"])
 def election_filelist():
     return json.dumps(ELECTION_FILES)
@@ -57,48 +120,84 @@ def election_filelist():
 def tallies_filelist():
     return json.dumps(RESULT_TALLIES_FILES)
 
-def submitfile(request, file_list):
+def submitfile(request, file_list, category):
     the_file = request.files['file']
     the_name = request.form['name']
 
     the_entry = find_by_name(file_list['inputFiles'], the_name)
     if the_entry:
+        # saved under a temporary name first, so a conversion running meanwhile never reads half a file
         the_path = os.path.join(FILES_DIR, the_name)
-        the_file.save(the_path)
+        tmp_fd, tmp_path = temporary_file(FILES_DIR)
+        with open(tmp_fd, "wb") as tmp_file:
+            the_file.save(tmp_file)
+        os.replace(tmp_path, the_path)
+        # the path may also be an output, whose hash and gzip copy are of the old content
+        discard_output_hash(the_path)
         the_entry['path'] = the_path
+        events.publish("upload", {"category": category, "name": the_name})
 
 @app.route('/convert/election/submitfile', methods=["POST"])
 def election_submitfile():
-    submitfile(request, ELECTION_FILES)
+    submitfile(request, ELECTION_FILES, 'election')
     return json.dumps({"status": "ok"})
 
 @app.route('/convert/tallies/submitfile', methods=["POST"])
 def tallies_submitfile():
-    submitfile(request, RESULT_TALLIES_FILES)
+    submitfile(request, RESULT_TALLIES_FILES, 'tallies')
     return json.dumps({"status": "ok"})
 
 @app.route('/convert/election/process', methods=["POST"])
 def election_process():
+    return run_profiled(request, ELECTION_FILES, 'Election Conversion Profile', process_election)
+
+def publish_failure(category, error):
+    # every processing event is followed by a processed one, even when the conversion fails, or the
+    # client goes away from a stream, so dashboards don't wait for it forever
+    events.publish("processed", {"category": category, "status": "failed", "error": str(error) or type(error).__name__})
+
+def process_election():
     for f in ELECTION_FILES['inputFiles']:
         if not f['path']:
             return json.dumps({"status": "not all files are ready to process"})
 
+    events.publish("processing", {"category": "election"})
+    try:
+        return convert_election()
+    except Exception as e:
+        publish_failure("election", e)
+        raise
+
+def convert_election():
+    # revised SEMS files only convert again what changed since the last conversion
     input_files = ELECTION_FILES['inputFiles']
-    vx_election = SEMSinput.process_election_files(
+    conversion = SEMSinput.reconvert_election_files(
         find_by_name(input_files, 'SEMS main file')['path'],
-        find_by_name(input_files, 'SEMS candidate mapping file')['path']
+        find_by_name(input_files, 'SEMS candidate mapping file')['path'],
+        ELECTION_CONVERSION['previous']
     )
+    ELECTION_CONVERSION['previous'] = conversion
+    vx_election = conversion['election']
 
     file_name = 'Vx Election Definition'
     the_path = os.path.join(FILES_DIR, file_name)
-    vx_file = open(the_path, "w")
-    vx_file.write(json.dumps(vx_election, indent=2))
-    vx_file.close()
+    save_output(the_path, SEMSinput.dump_election(vx_election, compact=flag(request, 'compact')))
 
     the_output_file = find_by_name(ELECTION_FILES['outputFiles'], file_name)
     the_output_file['path']= the_path
-    
-    return json.dumps({"status": "ok"})
+
+    # the SQLite database of the election, for SQL exports, built from the election just converted
+    if flag(request, 'database'):
+        tmp_fd, tmp_path = temporary_file(FILES_DIR)
+        os.close(tmp_fd)
+        SEMSoutput.create_election_database(vx_election, tmp_path).close()
+        the_path = os.path.join(FILES_DIR, 'Vx Election Database')
+        save_output(the_path, open(tmp_path, "rb").read())
+        os.remove(tmp_path)
+        find_by_name(ELECTION_FILES['outputFiles'], 'Vx Election Database')['path'] = the_path
+
+    events.publish("processed", {"category": "election", "status": "ok"})
+    return json.dumps({"status": "ok", "changes": conversion['changes']})
 
 @app.route('/convert/election/output', methods=["GET"])
 def election_output():
@@ -106,40 +205,125 @@ def election_output():
     the_entry = find_by_name(ELECTION_FILES['outputFiles'], the_name)
 
     if the_entry and the_entry['path']:
-        return send_file(the_entry['path'])
+        return send_output(request, the_entry['path'])
     else:
         return "", 404
 
+def tallies_sems_chunks(request, discrepancies=None, precinct_ids=None, contest_ids=None, summary=None):
+    # the SEMS rows for the uploaded tallies, using the Vx Election Definition, or the Vx Election Database
+    # with sql=true. None if the files needed haven't all been uploaded.
+    paths = dict((f['name'], f['path']) for f in RESULT_TALLIES_FILES['inputFiles'])
+
+    if flag(request, 'sql'):
+        if not paths['Vx Election Database'] or not paths['Vx Tallies']:
+            return None
+        return SEMSoutput.generate_sems_results_sql(
+            paths['Vx Election Database'], [paths['Vx Tallies']], [], paths['SEMS Results to merge'], precinct_ids, contest_ids, summary)
+
+    if not paths['Vx Election Definition'] or not paths['Vx Tallies']:
+        return None
+    workers = app.config['EXPORT_WORKERS'] if request.values.get('parallel', 'true').lower() not in ("0", "false", "no") else 0
+    return SEMSoutput.generate_sems_results(
+        paths['Vx Election Definition'], paths['Vx Tallies'], paths['SEMS Results to merge'], discrepancies, precinct_ids, contest_ids, summary,
+        workers)
+
 @app.route('/convert/tallies/process', methods=["POST"])
 def tallies_process():
-    for f in RESULT_TALLIES_FILES['inputFiles']:
-        if not f['path']:
-            return json.dumps({"status": "not all files are ready to process"})
+    return run_profiled(request, RESULT_TALLIES_FILES, 'Tallies Conversion Profile', process_tallies)
+
+def process_tallies():
+    # validate=warn reports discrepancies in the tallies, validate=fail also refuses to write the results
+    validate = request.values.get('validate')
+    discrepancies = [] if validate in ('warn', 'fail') else None
+    if discrepancies is not None and flag(request, 'sql'):
+        return json.dumps({"status": "validation needs the Vx Election Definition, not the database"})
+
+    # county-wide totals, added up while the rows are generated
+    summary = {}
+    sems_chunks = tallies_sems_chunks(request, discrepancies, summary=summary)
+    if sems_chunks is None:
+        return json.dumps({"status": "not all files are ready to process"})
 
-    sems_result = SEMSoutput.process_tallies_file(
-        find_by_name(RESULT_TALLIES_FILES['inputFiles'], 'Vx Election Definition')['path'],
-        find_by_name(RESULT_TALLIES_FILES['inputFiles'], 'Vx Tallies')['path']
-    )
     the_path = os.path.join(FILES_DIR, 'SEMS Results')
-    result_file = open(the_path, "w")
-    result_file.write(sems_result)
-    result_file.close()
+    events.publish("processing", {"category": "tallies"})
+
+    # discrepancies are only all known at the end, so failing means we can't stream
+    if validate == 'fail':
+        try:
+            sems_chunks = ["".join(sems_chunks)]
+        except Exception as e:
+            publish_failure("tallies", e)
+            raise
+        if discrepancies:
+            events.publish("processed", {"category": "tallies", "status": "tallies failed validation"})
+            return json.dumps({"status": "tallies failed validation", "discrepancies": discrepancies})
+
+    def write_results():
+        try:
+            yield from tee_output(the_path, sems_chunks)
+            find_by_name(RESULT_TALLIES_FILES['outputFiles'], 'SEMS Results')['path'] = the_path
 
-    find_by_name(RESULT_TALLIES_FILES['outputFiles'], 'SEMS Results')['path'] = the_path
+            for name, content in [('SEMS Results Summary', json.dumps(summary, indent=2)), ('SEMS Results Summary CSV', SEMSoutput.summary_csv(summary))]:
+                summary_path = os.path.join(FILES_DIR, name)
+                save_output(summary_path, content)
+                find_by_name(RESULT_TALLIES_FILES['outputFiles'], name)['path'] = summary_path
+        except BaseException as e:
+            publish_failure("tallies", e)
+            raise
+        for d in discrepancies or []:
+            app.logger.warning("tallies discrepancy: %s", d)
+        events.publish("processed", {"category": "tallies", "status": "ok"})
 
+    # streaming sends the rows back as they are generated, while still saving the output,
+    # which would happen after the profiler is done
+    if flag(request, 'stream') and validate != 'fail' and not profile_requested(request):
+        return Response(stream_with_context(write_results()), mimetype='text/csv')
+
+    for _ in write_results():
+        pass
+
+    if discrepancies is not None:
+        return json.dumps({"status": "ok", "discrepancies": discrepancies})
     return json.dumps({"status": "ok"})
-    
+
+
+def id_list(request, name):
+    value = request.values.get(name)
+    return value.split(",") if value else None
+
+@app.route('/convert/tallies/partial', methods=["GET"])
+def tallies_partial():
+    # SEMS rows for just some precincts and/or contests, returned directly rather than saved as the output
+    sems_chunks = tallies_sems_chunks(request, precinct_ids=id_list(request, 'precincts'), contest_ids=id_list(request, 'contests'))
+    if sems_chunks is None:
+        return json.dumps({"status": "not all files are ready to process"})
+    return Response("".join(sems_chunks), mimetype='text/csv')
     
 @app.route('/convert/tallies/output', methods=["GET"])
 def tallies_output():
     the_name = request.args.get('name', None)
     the_entry = find_by_name(RESULT_TALLIES_FILES['outputFiles'], the_name)
+    if not the_entry:
+        return "", 404
 
-    if the_entry and the_entry['path']:
-        return send_file(the_entry['path'])
+    # the outputs in the workspace were written since the last reset, by us or by the watcher (see watch.py)
+    the_path = the_entry['path'] or os.path.join(FILES_DIR, the_entry['name'])
+    if os.path.isfile(the_path):
+        return send_output(request, the_path)
     else:
         return "", 404
 
+@app.route('/convert/events', methods=["GET"])
+def convert_events():
+    # server-sent events: upload, processing, processed, output (with the output's new hash) and reset
+    last_event_id = request.headers.get('Last-Event-ID')
+    subscriber = events.subscribe(int(last_event_id) if last_event_id and last_event_id.isdigit() else None)
+    response = Response(events.event_stream(subscriber), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # nginx would otherwise hold the events back
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 @app.route('/convert/reset', methods=["POST"])
 def convert_reset():
     reset()
@@ -150,13 +334,23 @@ def index_test(): # pragma: no cover this is just for testing
     return send_from_directory(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'), 'index.html')
 
 def reset():
+    # a new workspace is created, uploads and outputs go there
+    os.makedirs(FILES_DIR, exist_ok=True)
     for category in [ELECTION_FILES, RESULTS_FILES, RESULT_TALLIES_FILES]:
         for file_list in [category['inputFiles'], category['outputFiles']]:
             for f in file_list:
                 the_path = os.path.join(FILES_DIR, f['name'])
-                if os.path.isfile(the_path):
-                    os.remove(the_path)
+                for path in [the_path, the_path + '.gz']:
+                    if os.path.isfile(path):
+                        os.remove(path)
                 f['path'] = None
+    # left behind by a server that stopped while writing
+    for name in os.listdir(FILES_DIR):
+        if name.startswith(TMP_PREFIX):
+            os.remove(os.path.join(FILES_DIR, name))
+    OUTPUT_HASHES.clear()
+    ELECTION_CONVERSION['previous'] = None
+    events.publish("reset", {})
                 
 # on startup, reset everything
 reset()
@@ -0,0 +1,77 @@
+#
+# Conversion events, pushed to clients as server-sent events so they don't have to poll
+#
+# Every subscriber gets a queue and publish() puts each event in all of them. The last few events are kept,
+# so a client that reconnects with a Last-Event-ID header gets the ones it missed.
+#
+# A client that goes away without its stream being closed stops reading, so once its queue is full
+# it is dropped, and its stream ends after the events already queued. A client that was only slow
+# reconnects with Last-Event-ID.
+#
+
+import collections, json, queue, threading
+
+HISTORY_SIZE = 100
+MAX_QUEUED_EVENTS = 1000
+
+# a comment is sent after this long without events, so proxies don't close the connection
+KEEPALIVE_SECONDS = 15
+
+# put in a dropped subscriber's queue, after its last event
+CLOSED = None
+
+EVENTS = {
+    "lock": threading.Lock(),
+    "nextId": 1,
+    "history": collections.deque(maxlen=HISTORY_SIZE),
+    "subscribers": []
+}
+
+def publish(kind, data):
+    with EVENTS["lock"]:
+        event = {"id": EVENTS["nextId"], "event": kind, "data": data}
+        EVENTS["nextId"] += 1
+        EVENTS["history"].append(event)
+        for subscriber in list(EVENTS["subscribers"]):
+            # queues have room for one more, for CLOSED
+            if subscriber.qsize() < MAX_QUEUED_EVENTS:
+                subscriber.put_nowait(event)
+            else:
+                EVENTS["subscribers"].remove(subscriber)
+                subscriber.put_nowait(CLOSED)
+    return event
+
+def subscribe(last_event_id=None):
+    # a queue of the events from now on, and from after last_event_id if it's still in the history
+    subscriber = queue.Queue(maxsize=MAX_QUEUED_EVENTS + 1)
+    with EVENTS["lock"]:
+        if last_event_id is not None:
+            for event in EVENTS["history"]:
+                if event["id"] > last_event_id:
+                    subscriber.put_nowait(event)
+        EVENTS["subscribers"].append(subscriber)
+    return subscriber
+
+def unsubscribe(subscriber):
+    with EVENTS["lock"]:
+        if subscriber in EVENTS["subscribers"]:
+            EVENTS["subscribers"].remove(subscriber)
+
+def format_event(event):
+    return "id: %d\nevent: %s\ndata: %s\n\n" % (event["id"], event["event"], json.dumps(event["data"]))
+
+def event_stream(subscriber):
+    try:
+        # sent right away, so the client knows it's connected
+        yield "retry: 1000\n\n"
+        while True:
+            try:
+                event = subscriber.get(timeout=KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if event is CLOSED:
+                return
+            yield format_event(event)
+    finally:
+        unsubscribe(subscriber)
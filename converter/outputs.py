@@ -0,0 +1,95 @@
+#
+# Writing outputs
+#
+# Every output is written along with a gzip copy, so downloads don't compress on every request, and the
+# sha256 of its content is kept, for ETags. The web server and the watch folder both write outputs this
+# way, into the same workspace.
+#
+
+import gzip, hashlib, os, tempfile
+
+from . import events
+
+# files being written are named with this prefix until they are complete
+TMP_PREFIX = '.writing-'
+
+# mkstemp makes files only their owner can read, while outputs and uploads should get the usual permissions.
+# The umask can only be read by setting it, so that's done once, here.
+UMASK = os.umask(0)
+os.umask(UMASK)
+FILE_MODE = 0o666 & ~UMASK
+
+def temporary_file(directory):
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=TMP_PREFIX)
+    os.chmod(tmp_path, FILE_MODE)
+    return fd, tmp_path
+
+# content hash of each output file, keyed by path, used as its ETag, along with the size and
+# modification time of the file it was computed from
+OUTPUT_HASHES = {}
+
+def tee_output(the_path, chunks):
+    # writes the chunks to the output as they are yielded, along with a precompressed copy
+    # so downloads don't compress on every request. Both go to temporary files first so that
+    # an interrupted stream never replaces a good output, with unique names since several
+    # requests can be converting at the same time.
+    digest = hashlib.sha256()
+    output_fd, output_tmp_path = temporary_file(os.path.dirname(the_path))
+    gz_fd, gz_tmp_path = temporary_file(os.path.dirname(the_path))
+    try:
+        with open(output_fd, "wb") as output_file, open(gz_fd, "wb") as gz_raw_file, gzip.GzipFile(fileobj=gz_raw_file, mode="wb") as gz_file:
+            for chunk in chunks:
+                data = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+                output_file.write(data)
+                gz_file.write(data)
+                digest.update(data)
+                yield data
+        os.replace(gz_tmp_path, the_path + '.gz')
+        os.replace(output_tmp_path, the_path)
+    finally:
+        # a client that disconnected mid-stream, or a conversion that failed, leaves no temporary files behind
+        for tmp_path in [gz_tmp_path, output_tmp_path]:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+    record_output_hash(the_path, digest.hexdigest())
+
+def file_signature(the_path):
+    stat = os.stat(the_path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+def record_output_hash(the_path, content_hash, signature=None):
+    previous = OUTPUT_HASHES.get(the_path)
+    OUTPUT_HASHES[the_path] = {"signature": signature or file_signature(the_path), "hash": content_hash}
+    if previous is None or previous["hash"] != content_hash:
+        events.publish("output", {"name": os.path.basename(the_path), "hash": content_hash})
+
+def save_output(the_path, content):
+    for _ in tee_output(the_path, [content]):
+        pass
+
+def output_hash(the_path):
+    # the hash of the file as it is now. A file written without save_output here, like an upload to the
+    # same path, or results written by a watch folder running in another process, is hashed again and
+    # gets a new gzip copy. The file itself is only read: it may be replaced with newer content meanwhile,
+    # in which case its signature no longer matches the one taken before reading, and it's hashed again.
+    signature = file_signature(the_path)
+    cached = OUTPUT_HASHES.get(the_path)
+    if cached and cached["signature"] == signature:
+        return cached["hash"]
+    content = open(the_path, "rb").read()
+    gz_fd, gz_tmp_path = temporary_file(os.path.dirname(the_path))
+    try:
+        with open(gz_fd, "wb") as gz_file:
+            gz_file.write(gzip.compress(content))
+        os.replace(gz_tmp_path, the_path + '.gz')
+    finally:
+        if os.path.isfile(gz_tmp_path):
+            os.remove(gz_tmp_path)
+    content_hash = hashlib.sha256(content).hexdigest()
+    record_output_hash(the_path, content_hash, signature)
+    return content_hash
+
+def discard_output_hash(the_path):
+    OUTPUT_HASHES.pop(the_path, None)
+    if os.path.isfile(the_path + '.gz'):
+        os.remove(the_path + '.gz')
@@ -0,0 +1,68 @@
+#
+# Profiling a single conversion
+#
+# The conversion runs under cProfile, and the profile is kept in two forms: the pstats file, for pstats,
+# snakeviz and the like, and collapsed stacks, one "outer;inner;... microseconds" line per stack, which
+# is what flamegraph.pl and speedscope read.
+#
+# cProfile only records which function called which, not whole stacks, so the stacks are rebuilt from the
+# call graph: the time of a function is shared out between the ways it was reached, in proportion to the
+# time spent in it from each of its callers.
+#
+
+import cProfile, marshal, os, pstats
+
+# paths carrying less time than this aren't followed, it keeps big call graphs from blowing up
+MIN_STACK_SECONDS = 1e-6
+
+def profile_call(func, *args, **kwargs):
+    # returns what func returns, and its profile as (pstats file content, collapsed stacks)
+    profile = cProfile.Profile()
+    result = profile.runcall(func, *args, **kwargs)
+    stats = pstats.Stats(profile).stats
+    return result, (marshal.dumps(stats), collapsed_stacks(stats))
+
+def function_label(func):
+    file_name, line, name = func
+    # built-ins show up as ("~", 0, "<built-in method ...>")
+    label = name if file_name == "~" else "%s (%s:%d)" % (name, os.path.basename(file_name), line)
+    return label.replace(";", ",")
+
+def collapsed_stacks(stats):
+    # stats maps each function to (primitive calls, calls, own time, cumulative time, callers),
+    # with callers mapping each caller to the same numbers for the calls it made
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, caller_stats in callers.items():
+            callees.setdefault(caller, {})[func] = caller_stats[3]
+
+    stack_times = {}
+
+    def visit(func, stack, path, share):
+        stack = stack + (function_label(func),)
+        stack_times[stack] = stack_times.get(stack, 0) + stats[func][2] * share
+        for callee, edge_time in callees.get(func, {}).items():
+            callee_time = stats[callee][3]
+            # recursive calls are already counted in the time of the outermost call
+            if callee in path or edge_time * share < MIN_STACK_SECONDS:
+                continue
+            visit(callee, stack, path | {callee}, share * min(1, edge_time / callee_time))
+
+    for func, func_stats in stats.items():
+        if not func_stats[4]:
+            visit(func, (), {func}, 1)
+
+    lines = []
+    for stack in sorted(stack_times):
+        microseconds = int(round(stack_times[stack] * 1000000))
+        if microseconds > 0:
+            lines.append("%s %d" % (";".join(stack), microseconds))
+    return "\n".join(lines) + "\n"
+
+def save_profile(profile, path_prefix):
+    # writes <path_prefix>.pstats and <path_prefix>.collapsed
+    stats, stacks = profile
+    with open(path_prefix + ".pstats", "wb") as stats_file:
+        stats_file.write(stats)
+    with open(path_prefix + ".collapsed", "w") as stacks_file:
+        stacks_file.write(stacks)
@@ -0,0 +1,132 @@
+#
+# Watch-folder mode: regenerate the SEMS results whenever new tallies land in the workspace
+#
+# The workspace uses the same file names as the web server, so files can be dropped in by hand,
+# copied in by another tool, or uploaded through the server.
+#
+# A file counts as changed once its size and modification time have stayed the same for a few seconds,
+# so we don't read a file that is still being written.
+#
+# The results are written like the server's outputs, with their gzip copy, see outputs.py.
+#
+# Refreshes are incremental: the parsed election and its index are kept until the election file changes,
+# and the rows of each precinct are kept until that precinct's tallies change.
+#
+# python -m converter.watch [workspace_directory]
+#
+
+import itertools, json, os, sys, time
+
+from .CVRs import update_cvr_index
+from .outputs import save_output
+from .SEMSoutput import index_election, tallies_rows, sems_chunks, sems_row_key, read_sems_results, merge_sems_results, sorted_sems_rows
+
+ELECTION_FILE = "Vx Election Definition"
+TALLIES_FILE = "Vx Tallies"
+MERGE_FILE = "SEMS Results to merge"
+CVRS_FILE = "Vx CVRs"
+OUTPUT_FILE = "SEMS Results"
+
+WATCHED_FILES = [ELECTION_FILE, TALLIES_FILE, MERGE_FILE, CVRS_FILE]
+
+# what malformed files raise, see refresh
+BAD_FILE_ERRORS = (ValueError, KeyError, TypeError, AttributeError, IndexError)
+
+def file_signature(the_path):
+    if not os.path.isfile(the_path):
+        return None
+    stat = os.stat(the_path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+def new_watch_state():
+    return {
+        # signature of each file when we last converted, and of files that changed since, with when we first saw them
+        "seen": {},
+        "pending": {},
+        "index": None,
+        # precinct id to (precinct tallies, rows)
+        "precinctRows": {}
+    }
+
+def settled_changes(directory, state, now, settle_seconds):
+    changed = []
+    for name in WATCHED_FILES:
+        signature = file_signature(os.path.join(directory, name))
+        if signature == state["seen"].get(name):
+            state["pending"].pop(name, None)
+            continue
+
+        pending = state["pending"].get(name)
+        if pending is None or pending[0] != signature:
+            state["pending"][name] = (signature, now)
+        elif now - pending[1] >= settle_seconds:
+            changed.append(name)
+    return changed
+
+def refresh(directory, state, now, settle_seconds=2):
+    # converts again if any of the files changed, returns what was done or None if nothing was
+    changed = settled_changes(directory, state, now, settle_seconds)
+    if not changed:
+        return None
+
+    for name in changed:
+        state["seen"][name] = state["pending"].pop(name)[0]
+
+    report = {"changed": changed, "precinctsRendered": 0}
+    paths = {name: os.path.join(directory, name) for name in WATCHED_FILES}
+
+    if CVRS_FILE in changed and state["seen"][CVRS_FILE]:
+        update_cvr_index(paths[CVRS_FILE])
+
+    if not state["seen"].get(ELECTION_FILE) or not state["seen"].get(TALLIES_FILE):
+        report["error"] = "waiting for the election definition and tallies"
+        return report
+
+    try:
+        if ELECTION_FILE in changed or state["index"] is None:
+            state["index"] = index_election(json.loads(open(paths[ELECTION_FILE], "r").read()))
+            state["precinctRows"] = {}
+        tallies = json.loads(open(paths[TALLIES_FILE], "r").read())
+        tallies_by_precinct = tallies["talliesByPrecinct"]
+    except BAD_FILE_ERRORS as e:
+        # try again from scratch when the files change next
+        state["index"] = None
+        report["error"] = "could not read the election definition or tallies: %r" % e
+        return report
+
+    try:
+        index = state["index"]
+        for precinct_id in sorted(index["contestsByPrecinct"]):
+            precinct_tallies = tallies_by_precinct.get(precinct_id, {})
+            cached = state["precinctRows"].get(precinct_id)
+            if cached is None or cached[0] != precinct_tallies:
+                rows = list(tallies_rows(index, tallies, precinct_ids=[precinct_id]))
+                state["precinctRows"][precinct_id] = (precinct_tallies, rows)
+                report["precinctsRendered"] += 1
+
+        rows = itertools.chain.from_iterable(state["precinctRows"][p][1] for p in sorted(state["precinctRows"]))
+        if state["seen"].get(MERGE_FILE):
+            vx_results = {sems_row_key(row): row for row in rows}
+            rows = sorted_sems_rows(merge_sems_results(vx_results, read_sems_results(paths[MERGE_FILE])))
+        output = "".join(sems_chunks(rows))
+    except BAD_FILE_ERRORS as e:
+        # the last results stay until the files change again
+        report["error"] = "could not convert the tallies: %r" % e
+        return report
+
+    save_output(os.path.join(directory, OUTPUT_FILE), output)
+    return report
+
+if __name__ == "__main__": # pragma: no cover this is the main
+    directory = sys.argv[1] if len(sys.argv) > 1 else (os.getenv("MODULE_SEMS_CONVERTER_WORKSPACE") or os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'election_files'))
+    state = new_watch_state()
+    print("watching %s" % directory)
+    while True:
+        try:
+            report = refresh(directory, state, time.monotonic())
+        except Exception as e:
+            # a file removed while it's read, say: keep watching
+            report = {"changed": [], "error": "could not refresh: %r" % e}
+        if report:
+            print("%s changed: %s" % (", ".join(report["changed"]), report.get("error") or "%d precincts updated" % report["precinctsRendered"]))
+        time.sleep(1)
@@ -0,0 +1,123 @@
+import pytest, json, os, shutil
+
+from converter.CVRs import build_cvr_index, update_cvr_index, cvr_index_path, read_cvrs, \
+    new_ballot_id_set, add_ballot_id, ballot_id_fingerprint, unique_cvrs, EMPTY_FINGERPRINT
+
+PARENT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+SAMPLE_FILES = os.path.join(PARENT_DIR, 'sample_files')
+SAMPLE_CVRS_FILE = os.path.join(SAMPLE_FILES, '10_8-26-2020-cvrs.txt')
+SAMPLE_B_CVRS_FILE = os.path.join(SAMPLE_FILES, '10_8-26-2020-b-cvrs.txt')
+
+def all_cvrs(cvr_file_path):
+    return [json.loads(line) for line in open(cvr_file_path, "r") if line.strip()]
+
+@pytest.fixture
+def cvr_file(tmp_path):
+    the_path = str(tmp_path / "cvrs.txt")
+    shutil.copy(SAMPLE_CVRS_FILE, the_path)
+    return the_path
+
+def test_build_cvr_index(cvr_file):
+    index = build_cvr_index(cvr_file)
+    cvrs = all_cvrs(cvr_file)
+
+    assert index["lines"] == len(cvrs) == 100
+    assert index["size"] == os.path.getsize(cvr_file)
+    assert sorted(index["precincts"]) == sorted(set(cvr["_precinctId"] for cvr in cvrs))
+    assert sum(len(offsets) for offsets in index["scanners"].values()) == 100
+
+def test_read_cvrs(cvr_file):
+    cvrs = all_cvrs(cvr_file)
+
+    assert list(read_cvrs(cvr_file)) == cvrs
+    assert os.path.isfile(cvr_index_path(cvr_file))
+
+    assert list(read_cvrs(cvr_file, precinct_id="6522")) == [cvr for cvr in cvrs if cvr["_precinctId"] == "6522"]
+    assert list(read_cvrs(cvr_file, precinct_id="6522", ballot_style_id="5", scanner_id="scanner-3")) == [
+        cvr for cvr in cvrs
+        if cvr["_precinctId"] == "6522" and cvr["_ballotStyleId"] == "5" and cvr["_scannerId"] == "scanner-3"]
+    assert list(read_cvrs(cvr_file, precinct_id="no-such-precinct")) == []
+
+def test_update_cvr_index_on_append(cvr_file):
+    index = update_cvr_index(cvr_file)
+    size = index["size"]
+
+    # half a line being written isn't indexed or read yet
+    new_lines = open(SAMPLE_B_CVRS_FILE, "r").readlines()[:3]
+    with open(cvr_file, "a") as f:
+        f.write(new_lines[0] + new_lines[1][:20])
+    index = update_cvr_index(cvr_file)
+    assert index["lines"] == 101
+    assert len(list(read_cvrs(cvr_file))) == 101
+
+    # the rest of it, with the last line missing its newline
+    with open(cvr_file, "a") as f:
+        f.write(new_lines[1][20:] + new_lines[2].strip())
+    index = update_cvr_index(cvr_file)
+    assert index["lines"] == 103
+    assert index == build_cvr_index(cvr_file)
+    assert list(read_cvrs(cvr_file))[100:] == [json.loads(line) for line in new_lines]
+
+    # the saved index was extended, not rebuilt
+    saved_index = json.loads(open(cvr_index_path(cvr_file), "r").read())
+    assert saved_index == index
+    assert saved_index["precincts"]["6522"][0] < size
+
+def test_update_cvr_index_on_rewrite(cvr_file):
+    update_cvr_index(cvr_file)
+
+    shutil.copy(SAMPLE_B_CVRS_FILE, cvr_file)
+    assert list(read_cvrs(cvr_file, precinct_id="6522")) == [cvr for cvr in all_cvrs(SAMPLE_B_CVRS_FILE) if cvr["_precinctId"] == "6522"]
+
+    # a shorter file can't have been appended to
+    with open(cvr_file, "w") as f:
+        f.write(open(SAMPLE_B_CVRS_FILE, "r").readline())
+    assert update_cvr_index(cvr_file)["lines"] == 1
+
+def test_empty_cvr_file(tmp_path):
+    empty_file = str(tmp_path / "empty.txt")
+    open(empty_file, "w").close()
+    assert list(read_cvrs(empty_file)) == []
+    assert update_cvr_index(empty_file)["lines"] == 0
+
+def test_ballot_id_set():
+    ballot_ids = new_ballot_id_set(capacity=4)
+    assert add_ballot_id(ballot_ids, "ballot-0")
+    assert not add_ballot_id(ballot_ids, "ballot-0")
+
+    # grows as it fills up, and keeps what it had
+    for i in range(1, 5000):
+        assert add_ballot_id(ballot_ids, "ballot-%d" % i)
+    assert ballot_ids["count"] == 5000
+    assert ballot_ids["capacity"] == 16384
+    assert len(ballot_ids["table"]) == 16 * 16384
+    for i in range(5000):
+        assert not add_ballot_id(ballot_ids, "ballot-%d" % i)
+
+def test_empty_fingerprint(monkeypatch):
+    # a fingerprint can't be mistaken for an empty slot
+    class ZeroDigest:
+        def __init__(self, *args, **kwargs):
+            pass
+        def digest(self):
+            return EMPTY_FINGERPRINT
+    monkeypatch.setattr("hashlib.blake2b", ZeroDigest)
+    assert ballot_id_fingerprint("anything") == b"\x01" + EMPTY_FINGERPRINT[1:]
+
+def test_unique_cvrs(tmp_path):
+    cvrs = all_cvrs(SAMPLE_CVRS_FILE)
+    lines = [json.dumps(cvrs[0]), json.dumps(dict(cvrs[1], _testBallot=True)), "", json.dumps(cvrs[0]),
+             json.dumps({k: v for k, v in cvrs[2].items() if k != "_ballotId"})]
+    cvr_file = tmp_path / "cvrs.txt"
+    cvr_file.write_text("\n".join(lines) + "\n")
+
+    skipped = []
+    assert list(unique_cvrs([str(cvr_file)], skipped)) == [cvrs[0], json.loads(lines[4])]
+    assert skipped == [
+        {"type": "test-ballot", "ballotId": cvrs[1]["_ballotId"], "file": str(cvr_file), "line": 2},
+        {"type": "duplicate-ballot", "ballotId": cvrs[0]["_ballotId"], "file": str(cvr_file), "line": 4}
+    ]
+
+    skipped = []
+    assert len(list(unique_cvrs([str(cvr_file)], skipped, include_test_ballots=True))) == 3
+    assert [cvr["line"] for cvr in skipped] == [4]
@@ -0,0 +1,54 @@
+import pytest, os
+
+from converter.SEMSdiff import diff_sems_results, format_diff, has_differences
+
+PARENT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+SAMPLE_FILES = os.path.join(PARENT_DIR, 'sample_files')
+RESULTS_FILE = os.path.join(SAMPLE_FILES, '53_Results.txt')
+DOUBLED_RESULTS_FILE = os.path.join(SAMPLE_FILES, '53_Results_Doubled.txt')
+
+def test_diff_identical_reordered(tmp_path):
+    lines = open(RESULTS_FILE, "r", newline="").readlines()
+    reordered_file = tmp_path / "reordered.txt"
+    reordered_file.write_text("".join(reversed(lines)) + "\r\n", newline="")
+
+    diff = diff_sems_results(RESULTS_FILE, str(reordered_file))
+    assert not has_differences(diff)
+    assert diff["identicalPrecincts"] == 20
+    assert format_diff(diff) == "0 added, 0 removed, 0 changed, 0 precincts differ, 20 precincts identical"
+
+def test_diff_doubled():
+    diff = diff_sems_results(RESULTS_FILE, DOUBLED_RESULTS_FILE)
+    assert has_differences(diff)
+    assert diff["added"] == []
+    assert diff["removed"] == []
+    for before_row, after_row in diff["changed"]:
+        assert after_row[10] == before_row[10] * 2
+    for totals in diff["precincts"].values():
+        assert totals["after"] == totals["before"] * 2
+
+def test_diff_added_removed_changed(tmp_path):
+    lines = open(RESULTS_FILE, "r", newline="").readlines()
+    before_file = tmp_path / "before.txt"
+    before_file.write_text("".join(lines), newline="")
+
+    # drop the first row, change the count of the second one and add a row for a new precinct
+    changed_line = lines[1].replace('"0",\r\n', '"7",\r\n')
+    added_line = lines[2].replace('"750000053"', '"999"')
+    after_file = tmp_path / "after.txt"
+    after_file.write_text("".join([changed_line, added_line] + lines[2:]), newline="")
+
+    diff = diff_sems_results(str(before_file), str(after_file))
+    assert [row[6] for row in diff["removed"]] == ["0"]
+    assert [(row[1], row[6]) for row in diff["added"]] == [("999", "2")]
+    assert [(before[10], after[10]) for before, after in diff["changed"]] == [(0, 7)]
+    totals = diff["precincts"]["750000053"]
+    assert totals["after"] - totals["before"] == 7
+    assert diff["precincts"]["999"] == {"before": 0, "after": 0}
+    assert diff["identicalPrecincts"] == 19
+
+    text = format_diff(diff)
+    assert "- precinct 750000053, contest 775013566 (District 16), candidate 0 (Write-in): 0" in text
+    assert "+ precinct 999" in text
+    assert "~ precinct 750000053, contest 775013566 (District 16), candidate 1 (Times Over Voted): 0 -> 7" in text
+    assert text.endswith("1 added, 1 removed, 1 changed, 2 precincts differ, 19 precincts identical")
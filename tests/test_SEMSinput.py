@@ -1,8 +1,9 @@
 from unittest.mock import patch
 
-import pytest, json, io, os
+import pytest, json, io, os, sqlite3
 
-from converter.SEMSinput import main
+from converter.SEMSinput import main, process_election_files, reconvert_election_files
+from converter.SEMSoutput import generate_sems_results_sql
 
 PARENT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
 FILES_DIR = os.path.join(PARENT_DIR, 'election_files')
@@ -48,3 +49,72 @@ def test_general_conversion():
         assert result.strip() == expected_result.strip()
 
     
+def test_election_database(tmp_path):
+    db_path = str(tmp_path / "election.db")
+    main(get_sample_file('53_5-2-2019.txt'), get_sample_file('53_CANDMAP_5-2-2019.txt'), db_path=db_path)
+
+    # converting again replaces the database
+    result = main(get_sample_file('53_5-2-2019.txt'), get_sample_file('53_CANDMAP_5-2-2019.txt'), db_path=db_path)
+    assert json.loads(result) == json.loads(open(get_sample_file('53_expected-election.json'), "r").read())
+
+    db = sqlite3.connect(db_path)
+    assert db.execute("select count(*) from sems_candidates").fetchone()[0] > 0
+    assert db.execute("select county_id from vx_county").fetchall() == [('53',)]
+
+    result = "".join(generate_sems_results_sql(db_path, [get_sample_file('53_tallies.json')]))
+    assert result.encode('utf-8') == open(get_sample_file('53_Results.txt'), "rb").read()
+
+def revised_file(tmp_path, filename, replacements):
+    text = open(get_sample_file(filename), "r").read()
+    for old, new in replacements:
+        assert old in text
+        text = text.replace(old, new)
+    revised = tmp_path / ("revised-" + filename)
+    revised.write_text(text)
+    return str(revised)
+
+def test_reconvert_election_files(tmp_path):
+    main_file = get_sample_file('53_5-2-2019.txt')
+    candmap_file = get_sample_file('53_CANDMAP_5-2-2019.txt')
+
+    conversion = reconvert_election_files(main_file, candmap_file)
+    assert conversion['changes'] == {"rebuilt": "everything"}
+    assert conversion['election'] == process_election_files(main_file, candmap_file)
+
+    unchanged = reconvert_election_files(main_file, candmap_file, conversion)
+    assert unchanged['changes']['rebuilt'] == "nothing"
+    assert unchanged['election'] == conversion['election']
+
+    revisions = [
+        # a contest title and a candidate's name
+        ([('"State Of Mississippi\\nGovernor\\n4 YEAR TERM', '"State Of Mississippi\\nGovernor (revised)\\n4 YEAR TERM'),
+          ('0, 1, 2, "Robert Gray"', '0, 1, 2, "Bob Gray"')],
+         ["contests"], ['775013743', '775013744']),
+        # a split moved to another ballot style
+        ([('4, 421, 852, 2271, "Bell Schoolhouse", 391, "7D"', '4, 421, 852, 2271, "Bell Schoolhouse", 391, "8D"')],
+         ["ballotStyles"], []),
+        # the election title
+        ([('"2019 MOCK Primary Election"', '"2019 Revised Primary Election"')], "everything", []),
+    ]
+    for replacements, rebuilt, contests_changed in revisions:
+        revised_main_file = revised_file(tmp_path, '53_5-2-2019.txt', replacements)
+        revised = reconvert_election_files(revised_main_file, candmap_file, conversion)
+        assert revised['changes']['rebuilt'] == rebuilt
+        assert revised['changes']['contestsChanged'] == contests_changed
+        assert revised['election'] == process_election_files(revised_main_file, candmap_file)
+        assert revised['election'] != conversion['election']
+
+        # and back again
+        assert reconvert_election_files(main_file, candmap_file, revised)['election'] == conversion['election']
+
+def test_reconvert_contest_moved_out_of_the_election(tmp_path):
+    main_file = get_sample_file('53_5-2-2019.txt')
+    candmap_file = get_sample_file('53_CANDMAP_5-2-2019.txt')
+    conversion = reconvert_election_files(main_file, candmap_file)
+
+    # a contest in a district that doesn't exist is left out
+    revised_main_file = revised_file(tmp_path, '53_5-2-2019.txt', [('7, 775013743, "Governor-Democrat",0, 0, 100000275', '7, 775013743, "Governor-Democrat",0, 0, 999')])
+    revised = reconvert_election_files(revised_main_file, candmap_file, conversion)
+    assert revised['changes']['rebuilt'] == ["contests"]
+    assert revised['election'] == process_election_files(revised_main_file, candmap_file)
+    assert '775013743' not in [c['id'] for c in revised['election']['contests']]
@@ -1,9 +1,14 @@
 from unittest.mock import patch
 
-import pytest, json, io, os
+import pytest, json, io, os, sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-from converter.SEMSoutput import process_tallies_file
+from converter.SEMSoutput import process_tallies_file, parse_sems_results, read_sems_results, merge_sems_results, sorted_sems_rows, sems_chunks, \
+    create_election_database, generate_sems_results_sql, index_election, tallies_rows, summary_csv, \
+    process_pool, pool_results, render_precincts, loaded_file, load_tallies
 
+TESTS_DIR = os.path.dirname(os.path.realpath(__file__))
 PARENT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
 SAMPLE_FILES = os.path.join(PARENT_DIR, 'sample_files')
 
@@ -48,3 +53,397 @@ def test_general_results_from_tallies():
         expected_result = expected_result_file.read()
 
         assert result.encode('utf-8') == expected_result
+
+def test_read_sems_results():
+    results = read_sems_results(get_sample_file('53_Results.txt'))
+    assert len(results) == 3512
+
+    row = results[('53', '750000053', '775013566', '1')]
+    assert row == ['53', '750000053', '775013566', 'District 16', '2', 'D', '1', 'Times Over Voted', '0', 'NP', 0]
+
+    # formatting the parsed rows gives back the same file
+    expected_result = open(get_sample_file('53_Results.txt'), "rb").read()
+    assert "".join(sems_chunks(sorted_sems_rows(results))).encode('utf-8') == expected_result
+
+def test_parse_sems_results_sums_repeated_rows():
+    line = '"53","750000053","775013566","District 16","2","D","1","Times Over Voted","0","NP","3",\r\n'
+    results = parse_sems_results([line, "\r\n", line])
+    assert list(results.values()) == [['53', '750000053', '775013566', 'District 16', '2', 'D', '1', 'Times Over Voted', '0', 'NP', 6]]
+
+def test_merge_sems_results():
+    results = read_sems_results(os.path.join(TESTS_DIR, 'sampleResults.txt'))
+    vx_results = read_sems_results(os.path.join(TESTS_DIR, 'sampleResults_vx.txt'))
+    merged = merge_sems_results(results, vx_results)
+
+    expected_result = open(os.path.join(TESTS_DIR, 'expectedCombinedResults.txt'), "rb").read()
+    assert "".join(sems_chunks(sorted_sems_rows(merged))).encode('utf-8') == expected_result
+
+    # the inputs are left alone
+    assert read_sems_results(os.path.join(TESTS_DIR, 'sampleResults.txt')) == results
+
+def test_results_from_tallies_merged_with_sems_results():
+    result = process_tallies_file(
+        get_sample_file('53_expected-election.json'),
+        get_sample_file('53_tallies.json'),
+        get_sample_file('53_Results.txt'))
+
+    expected_result = open(get_sample_file('53_Results_Doubled.txt'), "rb").read()
+    assert result.encode('utf-8') == expected_result
+
+def test_compact_election_index():
+    index = index_election(json.loads(open(get_sample_file('53_expected-election.json'), "r").read()))
+    contest = index['contestsById']['775013566']
+    assert contest.seats == 1
+    assert contest.labels == ('775013566', 'District 16', '2', 'D')
+    assert [row.option_id for row in contest.option_rows] == sorted(row.option_id for row in contest.option_rows)
+    assert [(row.option_id, row.tally_key, row.in_metadata) for row in contest.option_rows[:3]] == [
+        ('0', '__write-in', False), ('1', 'overvotes', True), ('2', 'undervotes', True)]
+    assert contest.option_rows[1].option_labels == ('1', 'Times Over Voted', '0', 'NP')
+    assert '__write-in' in contest.tally_keys and 'overvotes' not in contest.tally_keys
+
+    # rows share the election's id strings rather than copies of them
+    tallies = json.loads(open(get_sample_file('53_tallies.json'), "r").read())
+    rows = list(tallies_rows(index, tallies, precinct_ids=['852']))
+    assert all(row[1] is rows[0][1] and row[0] is index['countyId'] for row in rows)
+    assert rows[1][:10] == ('53', '852', '775013566', 'District 16', '2', 'D', '1', 'Times Over Voted', '0', 'NP')
+
+def write_bad_tallies(tmp_path):
+    tallies = json.loads(open(get_sample_file('53_tallies.json'), "r").read())
+    precinct_tallies = tallies['talliesByPrecinct']['750000053']
+    precinct_tallies['775013566']['tallies']['575021682'] = 3
+    precinct_tallies['775013566']['tallies']['nobody'] = 0
+    precinct_tallies['775013566']['metadata']['ballots'] = 2
+    precinct_tallies['no-such-contest'] = {}
+    tallies['talliesByPrecinct']['no-such-precinct'] = {}
+
+    bad_tallies_file = tmp_path / "bad-tallies.json"
+    bad_tallies_file.write_text(json.dumps(tallies))
+    return str(bad_tallies_file)
+
+def test_validate_tallies(tmp_path):
+    discrepancies = []
+    result = process_tallies_file(
+        get_sample_file('53_expected-election.json'),
+        write_bad_tallies(tmp_path),
+        discrepancies=discrepancies)
+
+    assert [(d['type'], d['precinctId'], d['contestId'], d['optionId']) for d in discrepancies] == [
+        ('unknown-precinct', 'no-such-precinct', None, None),
+        ('unknown-contest', '750000053', 'no-such-contest', None),
+        ('unknown-option', '750000053', '775013566', 'nobody'),
+        ('inconsistent-counts', '750000053', '775013566', None)
+    ]
+    assert discrepancies[3]['message'] == "votes, overvotes and undervotes add up to 3, expected 2 for 2 ballots"
+
+    # the results are generated all the same
+    assert len(result.split("\r\n")) == len(open(get_sample_file('53_Results.txt'), "rb").read().split(b"\r\n"))
+
+def test_validate_good_tallies():
+    for test in TESTS:
+        discrepancies = []
+        process_tallies_file(get_sample_file(test['election']), get_sample_file(test['tallies']), discrepancies=discrepancies)
+        assert discrepancies == []
+
+def expected_lines(filename, precinct_ids=None, contest_ids=None):
+    lines = open(get_sample_file(filename), "rb").read().split(b"\r\n")[:-1]
+    return [line + b"\r\n" for line in lines
+            if (precinct_ids is None or line.split(b'","')[1].decode() in precinct_ids)
+            and (contest_ids is None or line.split(b'","')[2].decode() in contest_ids)]
+
+def test_partial_results():
+    election_file = get_sample_file('53_expected-election.json')
+    tallies_file = get_sample_file('53_tallies.json')
+
+    result = process_tallies_file(election_file, tallies_file, precinct_ids=['852'])
+    assert result.encode('utf-8') == b"".join(expected_lines('53_Results.txt', precinct_ids=['852']))
+
+    result = process_tallies_file(election_file, tallies_file, contest_ids=['775013566', '775013573'])
+    assert result.encode('utf-8') == b"".join(expected_lines('53_Results.txt', contest_ids=['775013566', '775013573']))
+
+    result = process_tallies_file(election_file, tallies_file, precinct_ids=['852', '853', 'no-such-precinct'], contest_ids=['775013573'])
+    assert result.encode('utf-8') == b"".join(expected_lines('53_Results.txt', precinct_ids=['852', '853'], contest_ids=['775013573']))
+    assert result != ""
+
+    result = process_tallies_file(election_file, tallies_file, get_sample_file('53_Results.txt'), precinct_ids=['852'], contest_ids=['775013573'])
+    assert result.encode('utf-8') == b"".join(expected_lines('53_Results_Doubled.txt', precinct_ids=['852'], contest_ids=['775013573']))
+
+def test_loaded_files_are_reused(tmp_path):
+    election_file = get_sample_file('53_expected-election.json')
+    tallies_file = get_sample_file('53_tallies.json')
+    process_tallies_file(election_file, tallies_file, precinct_ids=['852'])
+
+    # the same content isn't parsed and indexed again
+    with patch('converter.SEMSoutput.index_election') as index_election_mock:
+        process_tallies_file(election_file, tallies_file, precinct_ids=['853'])
+        index_election_mock.assert_not_called()
+
+    # while changed content is, even at the same path and of the same size
+    changing_file = tmp_path / "tallies.json"
+    changing_file.write_text('{"version": 1}')
+    loaded = loaded_file("tallies", str(changing_file), json.loads)
+    assert loaded == {"version": 1}
+    assert loaded_file("tallies", str(changing_file), json.loads) is loaded
+    changing_file.write_text('{"version": 2}')
+    mtime_ns = os.stat(str(changing_file)).st_mtime_ns
+    os.utime(str(changing_file), ns=(mtime_ns, mtime_ns + 1000000))
+    assert loaded_file("tallies", str(changing_file), json.loads) == {"version": 2}
+
+def election_database(tmp_path, election_filename):
+    db_path = str(tmp_path / (election_filename + ".db"))
+    if not os.path.isfile(db_path):
+        create_election_database(json.loads(open(get_sample_file(election_filename), "r").read()), db_path).close()
+    return db_path
+
+def test_sql_results_from_tallies(tmp_path):
+    for test in TESTS:
+        result = "".join(generate_sems_results_sql(election_database(tmp_path, test['election']), [get_sample_file(test['tallies'])]))
+        assert result.encode('utf-8') == open(get_sample_file(test['sems']), "rb").read()
+
+def test_sql_results_from_cvrs(tmp_path):
+    db_path = election_database(tmp_path, 'electionPrimarySample.json')
+    # a copy, so the CVR index isn't saved in sample_files
+    cvr_file = tmp_path / "cvrs.txt"
+    cvr_file.write_bytes(open(get_sample_file('election-primary-sample-cvrs.txt'), "rb").read())
+    # these are all test ballots
+    summary = {}
+    result = "".join(generate_sems_results_sql(db_path, cvr_file_paths=[str(cvr_file)], include_test_ballots=True, summary=summary))
+    assert result.encode('utf-8') == open(get_sample_file('election-primary-expected-results.csv'), "rb").read()
+
+    # each CVR with a contest is one of its ballots
+    cvrs = [json.loads(line) for line in open(str(cvr_file), "r") if line.strip()]
+    for contest in summary['contests']:
+        assert (contest['ballots'], contest['derivedBallots']) == (sum(1 for cvr in cvrs if contest['contestId'] in cvr), 0)
+
+    skipped_cvrs = []
+    result = "".join(generate_sems_results_sql(db_path, cvr_file_paths=[str(cvr_file)], skipped_cvrs=skipped_cvrs))
+    assert [(cvr['type'], cvr['line']) for cvr in skipped_cvrs] == [('test-ballot', line) for line in range(1, 20)]
+    assert len(result.split("\r\n")) == len(open(get_sample_file('election-primary-expected-results.csv'), "rb").read().split(b"\r\n"))
+    assert all(row.endswith('"0",') for row in result.split("\r\n")[:-1])
+
+def test_sql_results_from_duplicated_cvrs(tmp_path):
+    db_path = election_database(tmp_path, '10_8-26-2020-expected-election.json')
+    cvr_file = tmp_path / "cvrs.txt"
+    cvr_file.write_bytes(open(get_sample_file('10_8-26-2020-cvrs.txt'), "rb").read())
+    result = "".join(generate_sems_results_sql(db_path, cvr_file_paths=[str(cvr_file)]))
+
+    # the same export imported again, and another export that overlaps the first by two ballots
+    lines = open(str(cvr_file), "rb").read().split(b"\n")
+    overlapping_file = tmp_path / "overlapping-cvrs.txt"
+    overlapping_file.write_bytes(b"\n".join(lines[98:]))
+    skipped_cvrs = []
+    duplicated_result = "".join(generate_sems_results_sql(
+        db_path, cvr_file_paths=[str(cvr_file), str(cvr_file), str(overlapping_file)], skipped_cvrs=skipped_cvrs))
+
+    assert duplicated_result == result
+    assert [(cvr['type'], cvr['file'], cvr['line']) for cvr in skipped_cvrs] == \
+        [('duplicate-ballot', str(cvr_file), line) for line in range(1, 101)] + \
+        [('duplicate-ballot', str(overlapping_file), line) for line in (1, 2)]
+    assert skipped_cvrs[0]['ballotId'] == json.loads(lines[0])['_ballotId']
+
+def test_sql_partial_and_merged_results(tmp_path):
+    db_path = election_database(tmp_path, '53_expected-election.json')
+    tallies_files = [get_sample_file('53_tallies.json')]
+
+    result = "".join(generate_sems_results_sql(db_path, tallies_files, precinct_ids=['852', '853'], contest_ids=['775013573']))
+    assert result.encode('utf-8') == b"".join(expected_lines('53_Results.txt', precinct_ids=['852', '853'], contest_ids=['775013573']))
+
+    result = "".join(generate_sems_results_sql(db_path, tallies_files, sems_results_file_path=get_sample_file('53_Results.txt')))
+    assert result.encode('utf-8') == open(get_sample_file('53_Results_Doubled.txt'), "rb").read()
+
+    # the same tallies twice add up
+    result = "".join(generate_sems_results_sql(db_path, tallies_files * 2))
+    assert result.encode('utf-8') == open(get_sample_file('53_Results_Doubled.txt'), "rb").read()
+
+    # the tallies are read once, and only the selected ones are loaded into the database
+    tallies = loaded_file("tallies", tallies_files[0], json.loads)
+    "".join(generate_sems_results_sql(db_path, tallies_files, precinct_ids=['852']))
+    assert loaded_file("tallies", tallies_files[0], json.loads) is tallies
+    db = sqlite3.connect(db_path)
+    load_tallies(db, tallies, precinct_ids=['852', '853', 'no-such-precinct'], contest_ids=['775013573'])
+    assert db.execute("select distinct precinct_id, contest_id from tallies order by precinct_id").fetchall() == \
+        [('852', '775013573'), ('853', '775013573')]
+    db.close()
+
+def test_sql_results_close_the_database(tmp_path):
+    db_path = election_database(tmp_path, '53_expected-election.json')
+    connections = []
+    sqlite3_connect = sqlite3.connect
+
+    def connect(path):
+        connections.append(sqlite3_connect(path))
+        return connections[-1]
+
+    with patch('converter.SEMSoutput.sqlite3.connect', side_effect=connect):
+        "".join(generate_sems_results_sql(db_path, [get_sample_file('53_tallies.json')]))
+        # and when the tallies can't be read
+        with pytest.raises(FileNotFoundError):
+            generate_sems_results_sql(db_path, [str(tmp_path / "no-such-tallies.json")])
+
+    for db in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            db.execute("select 1")
+
+def test_summary(tmp_path):
+    summary = {}
+    result = process_tallies_file(get_sample_file('53_expected-election.json'), get_sample_file('53_tallies.json'), summary=summary)
+    assert result.encode('utf-8') == open(get_sample_file('53_Results.txt'), "rb").read()
+    assert summary['countyId'] == '53'
+
+    # the same totals as adding up the SEMS file
+    totals = {}
+    for row in read_sems_results(get_sample_file('53_Results.txt')).values():
+        totals[(row[2], row[6])] = totals.get((row[2], row[6]), 0) + row[10]
+    tallies = json.loads(open(get_sample_file('53_tallies.json'), "r").read())
+    for contest in summary['contests']:
+        assert contest['overvotes'] == totals[(contest['contestId'], '1')]
+        assert contest['undervotes'] == totals[(contest['contestId'], '2')]
+        for option in contest['options']:
+            assert option['votes'] == totals[(contest['contestId'], option['candidateId'])]
+        assert contest['votes'] == sum(option['votes'] for option in contest['options'])
+        assert contest['ballots'] == sum(precinct_tallies[contest['contestId']]['metadata']['ballots']
+                                         for precinct_tallies in tallies['talliesByPrecinct'].values()
+                                         if contest['contestId'] in precinct_tallies)
+        assert contest['derivedBallots'] == 0
+    assert len(summary['contests']) == len(set(key[0] for key in totals))
+
+    # the SQL export sums up the same
+    sql_summary = {}
+    "".join(generate_sems_results_sql(election_database(tmp_path, '53_expected-election.json'), [get_sample_file('53_tallies.json')], summary=sql_summary))
+    assert sql_summary == summary
+
+    lines = summary_csv(summary).split("\r\n")
+    assert lines[0] == "contest_id,contest_title,party_id,candidate_id,candidate_name,candidate_party_id,count"
+    contest = summary['contests'][0]
+    assert lines[1] == "%s,%s,%s,,Ballots,0,%d" % (contest['contestId'], contest['title'], contest['partyId'], contest['ballots'])
+    assert len(lines) == 2 + sum(3 + len(contest['options']) for contest in summary['contests'])
+
+def test_summary_ballots(tmp_path):
+    election_file = get_sample_file('53_expected-election.json')
+    db_path = election_database(tmp_path, '53_expected-election.json')
+    tallies = json.loads(open(get_sample_file('53_tallies.json'), "r").read())
+
+    def contest_summary(summary, contest_id='775013566'):
+        return [contest for contest in summary['contests'] if contest['contestId'] == contest_id][0]
+
+    def sql_summary(tallies_file, sems_results_file=None):
+        summary = {}
+        "".join(generate_sems_results_sql(db_path, [tallies_file], sems_results_file_path=sems_results_file, summary=summary))
+        return summary
+
+    summary = {}
+    process_tallies_file(election_file, get_sample_file('53_tallies.json'), summary=summary)
+    ballots = contest_summary(summary)['ballots']
+
+    # inconsistent tallies still report the ballots they counted
+    precinct_tallies = tallies['talliesByPrecinct']['750000053']['775013566']
+    precinct_tallies['metadata']['undervotes'] += 5
+    inconsistent_tallies_file = tmp_path / "inconsistent-tallies.json"
+    inconsistent_tallies_file.write_text(json.dumps(tallies))
+    for workers in [None, 2]:
+        inconsistent_summary = {}
+        process_tallies_file(election_file, str(inconsistent_tallies_file), summary=inconsistent_summary, workers=workers)
+        assert contest_summary(inconsistent_summary)['ballots'] == ballots
+    assert contest_summary(sql_summary(str(inconsistent_tallies_file)))['ballots'] == ballots
+
+    # without a ballot count they are worked out, and marked as derived
+    precinct_tallies['metadata']['undervotes'] -= 5
+    precinct_ballots = precinct_tallies['metadata'].pop('ballots')
+    uncounted_tallies_file = tmp_path / "uncounted-tallies.json"
+    uncounted_tallies_file.write_text(json.dumps(tallies))
+    uncounted_summary = {}
+    process_tallies_file(election_file, str(uncounted_tallies_file), summary=uncounted_summary)
+    assert (contest_summary(uncounted_summary)['ballots'], contest_summary(uncounted_summary)['derivedBallots']) == (ballots, precinct_ballots)
+    assert sql_summary(str(uncounted_tallies_file)) == uncounted_summary
+
+    # so are the ballots of merged SEMS results
+    merged_summary = {}
+    process_tallies_file(election_file, get_sample_file('53_tallies.json'), get_sample_file('53_Results.txt'), summary=merged_summary)
+    assert (contest_summary(merged_summary)['ballots'], contest_summary(merged_summary)['derivedBallots']) == (2 * ballots, ballots)
+    assert sql_summary(get_sample_file('53_tallies.json'), get_sample_file('53_Results.txt')) == merged_summary
+
+def test_parallel_results(tmp_path):
+    for test in TESTS:
+        result = process_tallies_file(get_sample_file(test['election']), get_sample_file(test['tallies']), workers=2)
+        assert result.encode('utf-8') == open(get_sample_file(test['sems']), "rb").read()
+
+    election_file = get_sample_file('53_expected-election.json')
+    tallies_file = get_sample_file('53_tallies.json')
+    results_file = get_sample_file('53_Results.txt')
+    for kwargs in [{'precinct_ids': ['852', '853', 'no-such-precinct'], 'contest_ids': ['775013573']},
+                   {'contest_ids': ['775013566']}, {'precinct_ids': []}]:
+        for merge_file in [None, results_file]:
+            assert process_tallies_file(election_file, tallies_file, merge_file, workers=3, **kwargs) == \
+                process_tallies_file(election_file, tallies_file, merge_file, **kwargs)
+
+    # merged results from another county go among the precincts in the same order
+    primary_args = [get_sample_file('electionPrimarySample.json'), get_sample_file('election-primary-sample-tallies.json'),
+                    get_sample_file('10_expected-sems-results.txt')]
+    assert process_tallies_file(*primary_args, workers=3) == process_tallies_file(*primary_args)
+
+    # merged results and their summary, with more workers than precincts
+    summary, parallel_summary = {}, {}
+    result = process_tallies_file(election_file, tallies_file, results_file, summary=summary)
+    assert process_tallies_file(election_file, tallies_file, results_file, summary=parallel_summary, workers=30) == result
+    assert parallel_summary == summary
+
+    # discrepancies come out in the same order
+    bad_tallies_file = write_bad_tallies(tmp_path)
+    discrepancies, parallel_discrepancies = [], []
+    process_tallies_file(election_file, bad_tallies_file, discrepancies=discrepancies)
+    process_tallies_file(election_file, bad_tallies_file, discrepancies=parallel_discrepancies, workers=2)
+    assert parallel_discrepancies == discrepancies
+
+    # the pool is kept between exports
+    assert process_pool(2) is process_pool(2)
+
+    # exports with different pool sizes at the same time don't shut the pool down under one another
+    expected = process_tallies_file(election_file, tallies_file)
+    with ThreadPoolExecutor(max_workers=4) as threads:
+        results = list(threads.map(lambda workers: process_tallies_file(election_file, tallies_file, workers=workers), [2, 3, 2, 3]))
+    assert results == [expected] * 4
+
+def exit_on_none(item):
+    # run in a worker, which dies on None
+    if item is None:
+        os._exit(1)
+    return item
+
+def test_broken_pool():
+    election_file = get_sample_file('53_expected-election.json')
+    tallies_file = get_sample_file('53_tallies.json')
+    expected = process_tallies_file(election_file, tallies_file)
+    assert process_tallies_file(election_file, tallies_file, workers=2) == expected
+
+    # a worker killed between exports breaks the pool, which is replaced for the next ones
+    pool = process_pool(2)
+    for process in list(pool._processes.values()):
+        process.kill()
+        process.join()
+    assert process_tallies_file(election_file, tallies_file, workers=2) == expected
+    assert process_tallies_file(election_file, tallies_file, workers=2) == expected
+    assert process_pool(2) is not pool
+
+    # a worker dying during an export fails it, again on the new pool, and the one after gets a new pool
+    pool = process_pool(2)
+    with pytest.raises(BrokenProcessPool):
+        list(pool_results(2, exit_on_none, [1, None]))
+    assert process_pool(2) is not pool
+    assert list(pool_results(2, exit_on_none, [1, 2, 3])) == [1, 2, 3]
+
+def test_render_precincts():
+    # the work done in each process, run here
+    index = index_election(json.loads(open(get_sample_file('53_expected-election.json'), "r").read()))
+    tallies = json.loads(open(get_sample_file('53_tallies.json'), "r").read())
+    other_results = read_sems_results(get_sample_file('53_Results.txt'))
+
+    text, discrepancies, totals, ballots = render_precincts((index, tallies, other_results, None, None, True, True))
+    assert text.encode('utf-8') == open(get_sample_file('53_Results_Doubled.txt'), "rb").read()
+    assert discrepancies == []
+    assert sum(option[3] for contest in totals.values() for option in contest[3].values()) == \
+        2 * sum(row[10] for row in other_results.values())
+    # just the ballots of the tallies, the other results are added up by the caller
+    assert all(derived == 0 for _, derived in ballots.values())
+
+    text, discrepancies, totals, ballots = render_precincts((index, tallies, None, ['852'], None, False, False))
+    assert text.encode('utf-8') == b"".join(expected_lines('53_Results.txt', precinct_ids=['852']))
+    assert discrepancies is None and totals is None and ballots is None
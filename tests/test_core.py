@@ -1,9 +1,10 @@
 
 from unittest.mock import patch
 
-import pytest, json, io, os
+import pytest, gzip, json, io, os
 
-from converter.core import app, reset
+from converter.core import app, reset, export_workers
+from converter import SEMSinput, watch
 
 PARENT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
 FILES_DIR = os.path.join(PARENT_DIR, 'election_files')
@@ -36,6 +37,7 @@ def client():
     yield client
 
     # any cleanup goes here
+    reset()
 
 def test_election_files(client):
     rv = json.loads(client.get('/convert/election/files').data)
@@ -121,3 +123,405 @@ def test_tallies_process(client):
     # try file after reset, shouldn't be there
     rv = client.get(results_url).data
     assert rv == b""
+
+def test_election_process_revised_files(client, tmp_path):
+    upload_file(client, '/convert/election/submitfile', SAMPLE_MAIN_FILE, {'name': 'SEMS main file'})
+    upload_file(client, '/convert/election/submitfile', SAMPLE_CANDIDATE_MAPPING_FILE, {'name': 'SEMS candidate mapping file'})
+    rv = json.loads(client.post('/convert/election/process').data)
+    assert rv == {"status": "ok", "changes": {"rebuilt": "everything"}}
+
+    revised_main_file = tmp_path / "revised.txt"
+    revised_main_file.write_text(open(SAMPLE_MAIN_FILE, "r").read().replace('"Robert Gray"', '"Bob Gray"'))
+    upload_file(client, '/convert/election/submitfile', str(revised_main_file), {'name': 'SEMS main file'})
+    rv = json.loads(client.post('/convert/election/process').data)
+    assert rv['changes']['rebuilt'] == ["contests"]
+    assert rv['changes']['contestsChanged'] == ['775013743']
+
+    election = json.loads(client.get('/convert/election/output?name=Vx%20Election%20Definition').data)
+    governor = [c for c in election['contests'] if c['id'] == '775013743'][0]
+    assert "Bob Gray" in [candidate['name'] for candidate in governor['candidates']]
+
+def test_election_process_compact(client):
+    upload_file(client, '/convert/election/submitfile', SAMPLE_MAIN_FILE, {'name': 'SEMS main file'})
+    upload_file(client, '/convert/election/submitfile', SAMPLE_CANDIDATE_MAPPING_FILE, {'name': 'SEMS candidate mapping file'})
+    client.post('/convert/election/process', data={'compact': 'true'})
+
+    election = client.get('/convert/election/output?name=Vx%20Election%20Definition').data
+    assert b"\n" not in election
+    assert json.loads(election) == json.loads(open(EXPECTED_ELECTION_FILE, "r").read())
+
+def test_tallies_output_gzip_and_etag(client):
+    upload_file(client, '/convert/tallies/submitfile', EXPECTED_ELECTION_FILE, {'name': 'Vx Election Definition'})
+    upload_file(client, '/convert/tallies/submitfile', SAMPLE_TALLIES_FILE, {'name': 'Vx Tallies'})
+    client.post("/convert/tallies/process")
+
+    results_url = '/convert/tallies/output?name=SEMS%20Results'
+    expected_results = open(EXPECTED_RESULTS_FILE, "rb").read()
+
+    rv = client.get(results_url, headers={'Accept-Encoding': 'gzip'})
+    assert rv.headers['Content-Encoding'] == 'gzip'
+    assert 'filename="SEMS Results"' in rv.headers['Content-Disposition']
+    assert gzip.decompress(rv.data) == expected_results
+
+    rv = client.get(results_url)
+    assert 'Content-Encoding' not in rv.headers
+    assert rv.data == expected_results
+
+    # polling again with the ETag we already have gets a 304
+    rv = client.get(results_url, headers={'If-None-Match': rv.headers['ETag']})
+    assert rv.status_code == 304
+    assert rv.data == b""
+
+    # same content reprocessed keeps the same ETag
+    etag = client.get(results_url).headers['ETag']
+    client.post("/convert/tallies/process")
+    assert client.get(results_url).headers['ETag'] == etag
+
+def test_tallies_output_from_watcher(client):
+    results_url = '/convert/tallies/output?name=SEMS%20Results'
+    assert client.get(results_url).status_code == 404
+    assert client.get('/convert/tallies/output?name=Vx%20Tallies').status_code == 404
+
+    # the watcher converts files dropped into the workspace
+    state = watch.new_watch_state()
+    open(os.path.join(FILES_DIR, 'Vx Election Definition'), "wb").write(open(EXPECTED_ELECTION_FILE, "rb").read())
+    open(os.path.join(FILES_DIR, 'Vx Tallies'), "wb").write(open(SAMPLE_TALLIES_FILE, "rb").read())
+    watch.refresh(FILES_DIR, state, 0)
+    watch.refresh(FILES_DIR, state, 2)
+
+    rv = client.get(results_url)
+    assert rv.data == open(EXPECTED_RESULTS_FILE, "rb").read()
+    etag = rv.headers['ETag']
+
+    open(os.path.join(FILES_DIR, 'SEMS Results to merge'), "wb").write(open(EXPECTED_RESULTS_FILE, "rb").read())
+    watch.refresh(FILES_DIR, state, 3)
+    watch.refresh(FILES_DIR, state, 5)
+
+    rv = client.get(results_url, headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.data == open(DOUBLED_EXPECTED_RESULTS_FILE, "rb").read()
+
+def test_output_overwritten_by_upload(client, tmp_path):
+    upload_file(client, '/convert/election/submitfile', SAMPLE_MAIN_FILE, {'name': 'SEMS main file'})
+    upload_file(client, '/convert/election/submitfile', SAMPLE_CANDIDATE_MAPPING_FILE, {'name': 'SEMS candidate mapping file'})
+    client.post('/convert/election/process')
+
+    election_url = '/convert/election/output?name=Vx%20Election%20Definition'
+    old_etag = client.get(election_url).headers['ETag']
+    client.get(election_url, headers={'Accept-Encoding': 'gzip'})
+
+    # the tallies upload of the election definition goes to the same path as the election output
+    other_election_file = tmp_path / "other-election.json"
+    other_election_file.write_text(json.dumps({"title": "another election"}))
+    upload_file(client, '/convert/tallies/submitfile', str(other_election_file), {'name': 'Vx Election Definition'})
+
+    # hashing the new content only reads the file
+    election_path = os.path.join(FILES_DIR, 'Vx Election Definition')
+    stat = os.stat(election_path)
+    rv = client.get(election_url)
+    assert (os.stat(election_path).st_ino, os.stat(election_path).st_mtime_ns) == (stat.st_ino, stat.st_mtime_ns)
+    assert json.loads(rv.data) == {"title": "another election"}
+    assert rv.headers['ETag'] != old_etag
+    assert client.get(election_url, headers={'If-None-Match': old_etag}).status_code == 200
+    rv = client.get(election_url, headers={'Accept-Encoding': 'gzip'})
+    assert json.loads(gzip.decompress(rv.data)) == {"title": "another election"}
+
+def test_output_rehash_failure(client):
+    upload_file(client, '/convert/tallies/submitfile', EXPECTED_ELECTION_FILE, {'name': 'Vx Election Definition'})
+    upload_file(client, '/convert/tallies/submitfile', SAMPLE_TALLIES_FILE, {'name': 'Vx Tallies'})
+    client.post("/convert/tallies/process")
+    results_path = os.path.join(FILES_DIR, 'SEMS Results')
+    open(results_path, "wb").write(open(DOUBLED_EXPECTED_RESULTS_FILE, "rb").read())
+
+    # a gzip copy that can't be written leaves no temporary file behind, and the output as it was
+    with patch('converter.outputs.gzip.compress', side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            client.get('/convert/tallies/output?name=SEMS%20Results')
+    assert not [name for name in os.listdir(FILES_DIR) if name.startswith('.writing-')]
+    assert client.get('/convert/tallies/output?name=SEMS%20Results').data == open(DOUBLED_EXPECTED_RESULTS_FILE, "rb").read()
+
+def test_reset_new_workspace(client, tmp_path):
+    workspace = str(tmp_path / "workspace")
+    with patch('converter.core.FILES_DIR', workspace):
+        reset()
+    assert os.path.isdir(workspace)
+
+def test_file_permissions(client):
+    umask = os.umask(0)
+    os.umask(umask)
+    upload_file(client, '/convert/tallies/submitfile', EXPECTED_ELECTION_FILE, {'name': 'Vx Election Definition'})
+    upload_file(client, '/convert/tallies/submitfile', SAMPLE_TALLIES_FILE, {'name': 'Vx Tallies'})
+    client.post("/convert/tallies/process")
+
+    # uploads and outputs follow the umask like any other file
+    for name in ['Vx Tallies', 'SEMS Results', 'SEMS Results.gz']:
+        assert os.stat(os.path.join(FILES_DIR, name)).st_mode & 0o777 == 0o666 & ~umask
+
+def test_export_workers():
+    assert export_workers(None) == 0
+    assert export_workers("4") == 4
+    for value in ["-1", "abc"]:
+        with pytest.raises(ValueError):
+            export_workers(value)
+
+def test_tallies_process_stream(client):
+    upload_file(client, '/convert/tallies/submitfile', EXPECTED_ELECTION_FILE, {'name': 'Vx Election Definition'})
+    upload_file(client, '/convert/tallies/submitfile', SAMPLE_TALLIES_FILE, {'name': 'Vx Tallies'})
+
+    expected_results = open(EXPECTED_RESULTS_FILE, "rb").read()
+
+    rv = client.post("/convert/tallies/process", data={'stream': 'true'}, buffered=False)
+    chunks = list(rv.response)
+    assert len(chunks) > 1
+    assert b"".join(chunks) == expected_results
+
+    # the streamed rows were also saved as the output
+    results = client.get('/convert/tallies/output?name=SEMS%20Results').data
+    assert results == expected_results
+
+def test_tallies_process_stream_disconnect(client):
+    upload_file(client, '/convert/tallies/submitfile', EXPECTED_ELECTION_FILE, {'name': 'Vx Election Definition'})
+    upload_file(client, '/convert/tallies/submitfile', SAMPLE_TALLIES_FILE, {'name': 'Vx Tallies'})
+
+    # the client goes away after the first rows
+    rv = client.post("/convert/tallies/process", data={'stream': 'true'}, buffered=False)
+    next(iter(rv.response))
+    rv.close()
+
+    assert not [name for name in os.listdir(FILES_DIR) if name.startswith('.writing-')]
+    assert client.get('/convert/tallies/output?name=SEMS%20Results').status_code == 404
+
+    # and anything left by a server that stopped mid-write goes on reset
+    open(os.path.join(FILES_DIR, '.writing-orphan'), "w").close()
+    reset()
+    assert not os.path.isfile(os.path.join(FILES_DIR, '.writing-orphan'))
+
+def test_tallies_process_merge(client):
+    upload_file(client, '/convert/tallies/submitfile', EXPECTED_ELECTION_FILE, {'name': 'Vx Election Definition'})
+    upload_file(client, '/convert/tallies/submitfile', SAMPLE_TALLIES_FILE, {'name': 'Vx Tallies'})
+    upload_file(client, '/convert/tallies/submitfile', EXPECTED_RESULTS_FILE, {'name': 'SEMS Results to merge'})
+
+    rv = client.post("/convert/tallies/process").data
+    assert json.loads(rv) == {"status": "ok"}
+
+    results = client.get('/convert/tallies/output?name=SEMS%20Results').data
+    assert results == open(DOUBLED_EXPECTED_RESULTS_FILE, "rb").read()
+
+    # the summary includes the merged results
+    summary = json.loads(client.get('/convert/tallies/output?name=SEMS%20Results%20Summary').data)
+    merged_total = sum(contest['votes'] + contest['overvotes'] + contest['undervotes'] for contest in summary['contests'])
+    assert merged_total == sum(int(line.split(b'","')[10].rstrip(b'",')) for line in results.split(b"\r\n")[:-1])
+    summary_csv = client.get('/convert/tallies/output?name=SEMS%20Results%20Summary%20CSV').data
+    assert summary_csv.startswith(b"contest_id,")
+
+def test_tallies_process_validate(client, tmp_path):
+    tallies = json.loads(open(SAMPLE_TALLIES_FILE, "r").read())
+    tallies['talliesByPrecinct']['no-such-precinct'] = {}
+    bad_tallies_file = tmp_path / "bad-tallies.json"
+    bad_tallies_file.write_text(json.dumps(tallies))
+
+    upload_file(client, '/convert/tallies/submitfile', EXPECTED_ELECTION_FILE, {'name': 'Vx Election Definition'})
+    upload_file(client, '/convert/tallies/submitfile', str(bad_tallies_file), {'name': 'Vx Tallies'})
+    results_url = '/convert/tallies/output?name=SEMS%20Results'
+
+    # failing validation doesn't write the results, even when asked to stream
+    rv = json.loads(client.post("/convert/tallies/process", data={'validate': 'fail', 'stream': 'true'}).data)
+    assert rv['status'] == "tallies failed validation"
+    assert [d['precinctId'] for d in rv['discrepancies']] == ['no-such-precinct']
+    assert client.get(results_url).status_code == 404
+
+    rv = json.loads(client.post("/convert/tallies/process", data={'validate': 'warn'}).data)
+    assert rv['status'] == "ok"
+    assert [d['precinctId'] for d in rv['discrepancies']] == ['no-such-precinct']
+    assert client.get(results_url).data == open(EXPECTED_RESULTS_FILE, "rb").read()
+
+    # streamed, the discrepancies are only logged
+    with patch.object(app.logger, 'warning') as warning:
+        rv = client.post("/convert/tallies/process", data={'validate': 'warn', 'stream': 'true'})
+        assert rv.data == open(EXPECTED_RESULTS_FILE, "rb").read()
+    assert [call.args[1]['precinctId'] for call in warning.call_args_list] == ['no-such-precinct']
+
+    app.config['EXPORT_WORKERS'] = 2
+    try:
+        rv = client.post("/convert/tallies/process", data={'validate': 'warn', 'stream': 'true'})
+        assert rv.data == open(EXPECTED_RESULTS_FILE, "rb").read()
+        # the pool can be turned off, but its size isn't up to the request
+        with patch('converter.SEMSoutput.parallel_sems_chunks') as parallel_sems_chunks:
+            rv = client.post("/convert/tallies/process", data={'validate': 'warn', 'parallel': 'false', 'workers': '-1'})
+            assert json.loads(rv.data)['status'] == "ok"
+            parallel_sems_chunks.assert_not_called()
+    finally:
+        app.config['EXPORT_WORKERS'] = 0
+
+    # good tallies pass
+    upload_file(client, '/convert/tallies/submitfile', SAMPLE_TALLIES_FILE, {'name': 'Vx Tallies'})
+    rv = json.loads(client.post("/convert/tallies/process", data={'validate': 'fail'}).data)
+    assert rv == {"status": "ok", "discrepancies": []}
+
+def test_tallies_partial(client):
+    partial_url = '/convert/tallies/partial?precincts=852,853&contests=775013573'
+
+    upload_file(client, '/convert/tallies/submitfile', EXPECTED_ELECTION_FILE, {'name': 'Vx Election Definition'})
+    assert b"not all files" in client.get(partial_url).data
+
+    upload_file(client, '/convert/tallies/submitfile', SAMPLE_TALLIES_FILE, {'name': 'Vx Tallies'})
+    rows = client.get(partial_url).data.split(b"\r\n")[:-1]
+    assert len(rows) > 0
+    for row in rows:
+        assert row.split(b'","')[1] in [b'852', b'853']
+        assert row.split(b'","')[2] == b'775013573'
+
+    # all of them without any filter
+    assert client.get('/convert/tallies/partial').data == open(EXPECTED_RESULTS_FILE, "rb").read()
+
+    # the partial export doesn't touch the output
+    assert client.get('/convert/tallies/output?name=SEMS%20Results').status_code == 404
+
+def test_election_database_and_sql_tallies(client):
+    upload_file(client, '/convert/election/submitfile', SAMPLE_MAIN_FILE, {'name': 'SEMS main file'})
+    upload_file(client, '/convert/election/submitfile', SAMPLE_CANDIDATE_MAPPING_FILE, {'name': 'SEMS candidate mapping file'})
+    # the database is built from the one conversion
+    with patch('converter.SEMSinput.process_election_rows', wraps=SEMSinput.process_election_rows) as process_election_rows:
+        client.post('/convert/election/process', data={'database': 'true'})
+        assert process_election_rows.call_count == 1
+    database = client.get('/convert/election/output?name=Vx%20Election%20Database').data
+    assert database.startswith(b"SQLite format 3")
+
+    database_file = os.path.join(FILES_DIR, 'downloaded.db')
+    open(database_file, "wb").write(database)
+    upload_file(client, '/convert/tallies/submitfile', database_file, {'name': 'Vx Election Database'})
+    os.remove(database_file)
+
+    rv = json.loads(client.post("/convert/tallies/process", data={'sql': 'true'}).data)
+    assert rv['status'] == "not all files are ready to process"
+
+    upload_file(client, '/convert/tallies/submitfile', SAMPLE_TALLIES_FILE, {'name': 'Vx Tallies'})
+    rv = json.loads(client.post("/convert/tallies/process", data={'sql': 'true', 'validate': 'warn'}).data)
+    assert "validation" in rv['status']
+
+    rv = json.loads(client.post("/convert/tallies/process", data={'sql': 'true'}).data)
+    assert rv == {"status": "ok"}
+    assert client.get('/convert/tallies/output?name=SEMS%20Results').data == open(EXPECTED_RESULTS_FILE, "rb").read()
+
+    rows = client.get('/convert/tallies/partial?sql=true&precincts=852').data.split(b"\r\n")[:-1]
+    assert len(rows) > 0
+    assert set(row.split(b'","')[1] for row in rows) == {b'852'}
+
+def test_profile_conversions(client):
+    upload_file(client, '/convert/election/submitfile', SAMPLE_MAIN_FILE, {'name': 'SEMS main file'})
+    upload_file(client, '/convert/election/submitfile', SAMPLE_CANDIDATE_MAPPING_FILE, {'name': 'SEMS candidate mapping file'})
+    profile_url = '/convert/election/output?name=Election%20Conversion%20Profile%20Stacks'
+
+    client.post('/convert/election/process')
+    assert client.get(profile_url).status_code == 404
+
+    rv = json.loads(client.post('/convert/election/process', data={'profile': 'true'}).data)
+    assert rv['status'] == "ok"
+    stacks = client.get(profile_url).data
+    assert b"process_election (core.py:" in stacks
+    assert client.get('/convert/election/output?name=Election%20Conversion%20Profile').status_code == 200
+
+    upload_file(client, '/convert/tallies/submitfile', EXPECTED_ELECTION_FILE, {'name': 'Vx Election Definition'})
+    upload_file(client, '/convert/tallies/submitfile', SAMPLE_TALLIES_FILE, {'name': 'Vx Tallies'})
+
+    # profiling doesn't stream, so that the whole conversion is in the profile
+    rv = client.post('/convert/tallies/process', data={'stream': 'true'}, headers={'X-Profile': 'true'})
+    assert json.loads(rv.data) == {"status": "ok"}
+    stacks = client.get('/convert/tallies/output?name=Tallies%20Conversion%20Profile%20Stacks').data
+    assert b"tallies_rows (SEMSoutput.py:" in stacks
+    assert client.get('/convert/tallies/output?name=SEMS%20Results').data == open(EXPECTED_RESULTS_FILE, "rb").read()
+
+def read_events(stream, count):
+    received = []
+    while len(received) < count:
+        chunk = next(stream).decode('utf-8')
+        if chunk.startswith("id: "):
+            _, kind, data = chunk.strip().split("\n")
+            received.append((kind[len("event: "):], json.loads(data[len("data: "):])))
+    return received
+
+def test_events(client):
+    rv = client.get('/convert/events', buffered=False)
+    assert rv.mimetype == 'text/event-stream'
+    stream = iter(rv.response)
+
+    upload_file(client, '/convert/tallies/submitfile', EXPECTED_ELECTION_FILE, {'name': 'Vx Election Definition'})
+    upload_file(client, '/convert/tallies/submitfile', SAMPLE_TALLIES_FILE, {'name': 'Vx Tallies'})
+    client.post('/convert/tallies/process')
+    received = read_events(stream, 6)
+    assert received[:3] == [
+        ("upload", {"category": "tallies", "name": "Vx Election Definition"}),
+        ("upload", {"category": "tallies", "name": "Vx Tallies"}),
+        ("processing", {"category": "tallies"})
+    ]
+    assert [(kind, data['name']) for kind, data in received[3:6]] == [
+        ("output", "SEMS Results"), ("output", "SEMS Results Summary"), ("output", "SEMS Results Summary CSV")]
+    assert received[3][1]['hash'] in client.get('/convert/tallies/output?name=SEMS%20Results').headers['ETag']
+    assert read_events(stream, 1) == [("processed", {"category": "tallies", "status": "ok"})]
+
+    # the same output again doesn't change its hash
+    client.post('/convert/tallies/process')
+    assert read_events(stream, 2) == [("processing", {"category": "tallies"}), ("processed", {"category": "tallies", "status": "ok"})]
+    rv.close()
+
+    # reconnecting picks up where the client left off
+    rv = client.get('/convert/events', headers={'Last-Event-ID': '0'}, buffered=False)
+    assert len(read_events(iter(rv.response), 8)) == 8
+    rv.close()
+
+def test_election_and_failed_validation_events(client, tmp_path):
+    rv = client.get('/convert/events', buffered=False)
+    stream = iter(rv.response)
+
+    upload_file(client, '/convert/election/submitfile', SAMPLE_MAIN_FILE, {'name': 'SEMS main file'})
+    upload_file(client, '/convert/election/submitfile', SAMPLE_CANDIDATE_MAPPING_FILE, {'name': 'SEMS candidate mapping file'})
+    client.post('/convert/election/process')
+    assert [kind for kind, _ in read_events(stream, 5)] == ["upload", "upload", "processing", "output", "processed"]
+
+    tallies = json.loads(open(SAMPLE_TALLIES_FILE, "r").read())
+    tallies['talliesByPrecinct']['no-such-precinct'] = {}
+    bad_tallies_file = tmp_path / "bad-tallies.json"
+    bad_tallies_file.write_text(json.dumps(tallies))
+    upload_file(client, '/convert/tallies/submitfile', EXPECTED_ELECTION_FILE, {'name': 'Vx Election Definition'})
+    upload_file(client, '/convert/tallies/submitfile', str(bad_tallies_file), {'name': 'Vx Tallies'})
+    client.post("/convert/tallies/process", data={'validate': 'fail'})
+    assert read_events(stream, 4)[2:] == [
+        ("processing", {"category": "tallies"}), ("processed", {"category": "tallies", "status": "tallies failed validation"})]
+
+    client.post('/convert/reset')
+    assert read_events(stream, 1) == [("reset", {})]
+    rv.close()
+
+def test_failed_processing_events(client):
+    rv = client.get('/convert/events', buffered=False)
+    stream = iter(rv.response)
+
+    upload_file(client, '/convert/election/submitfile', SAMPLE_MAIN_FILE, {'name': 'SEMS main file'})
+    upload_file(client, '/convert/election/submitfile', SAMPLE_CANDIDATE_MAPPING_FILE, {'name': 'SEMS candidate mapping file'})
+    with patch('converter.SEMSinput.reconvert_election_files', side_effect=ValueError("bad SEMS file")):
+        with pytest.raises(ValueError):
+            client.post('/convert/election/process')
+    assert read_events(stream, 4)[2:] == [
+        ("processing", {"category": "election"}), ("processed", {"category": "election", "status": "failed", "error": "bad SEMS file"})]
+
+    def failing_rows(*args):
+        raise ValueError("bad tallies")
+        yield
+
+    upload_file(client, '/convert/tallies/submitfile', EXPECTED_ELECTION_FILE, {'name': 'Vx Election Definition'})
+    upload_file(client, '/convert/tallies/submitfile', SAMPLE_TALLIES_FILE, {'name': 'Vx Tallies'})
+    read_events(stream, 2)
+    with patch('converter.SEMSoutput.tallies_rows', failing_rows):
+        for data in [{}, {'validate': 'fail'}]:
+            with pytest.raises(ValueError):
+                client.post('/convert/tallies/process', data=data)
+            assert read_events(stream, 2) == [
+                ("processing", {"category": "tallies"}), ("processed", {"category": "tallies", "status": "failed", "error": "bad tallies"})]
+
+    # and a client going away from a stream
+    stream_rv = client.post("/convert/tallies/process", data={'stream': 'true'}, buffered=False)
+    next(iter(stream_rv.response))
+    stream_rv.close()
+    assert read_events(stream, 2) == [
+        ("processing", {"category": "tallies"}), ("processed", {"category": "tallies", "status": "failed", "error": "GeneratorExit"})]
+    rv.close()
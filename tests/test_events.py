@@ -0,0 +1,50 @@
+import json, queue
+
+import pytest
+
+from converter import events
+
+@pytest.fixture
+def subscriber():
+    subscriber = events.subscribe()
+    yield subscriber
+    events.unsubscribe(subscriber)
+
+def test_publish_and_subscribe(subscriber):
+    event = events.publish("upload", {"name": "Vx Tallies"})
+    assert subscriber.get_nowait() == event
+    assert events.format_event(event) == 'id: %d\nevent: upload\ndata: {"name": "Vx Tallies"}\n\n' % event["id"]
+
+    # events since the last one the client saw
+    later_event = events.publish("processing", {})
+    missed = events.subscribe(event["id"] - 1)
+    assert [missed.get_nowait(), missed.get_nowait()] == [event, later_event]
+    events.unsubscribe(missed)
+    events.unsubscribe(missed)
+
+def test_full_subscriber_is_dropped(monkeypatch):
+    monkeypatch.setattr(events, "MAX_QUEUED_EVENTS", 1)
+    subscriber = events.subscribe()
+    events.publish("upload", {})
+    assert subscriber in events.EVENTS["subscribers"]
+    events.publish("upload", {})
+    assert subscriber not in events.EVENTS["subscribers"]
+
+    # its stream ends after the event it had, so the client reconnects
+    stream = events.event_stream(subscriber)
+    assert next(stream) == "retry: 1000\n\n"
+    assert next(stream).startswith("id: ")
+    assert list(stream) == []
+
+def test_event_stream(subscriber, monkeypatch):
+    monkeypatch.setattr(events, "KEEPALIVE_SECONDS", 0.01)
+    stream = events.event_stream(subscriber)
+    assert next(stream) == "retry: 1000\n\n"
+    assert next(stream) == ": keepalive\n\n"
+
+    event = events.publish("processed", {"status": "ok"})
+    assert next(stream) == events.format_event(event)
+
+    # closing the stream unsubscribes
+    stream.close()
+    assert subscriber not in events.EVENTS["subscribers"]
@@ -0,0 +1,45 @@
+import marshal, os, pstats
+
+from converter.profiling import profile_call, collapsed_stacks, function_label, save_profile
+
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+def work():
+    return [fib(15) for _ in range(3)] + [sorted(range(1000))[0]]
+
+def test_profile_call(tmp_path):
+    result, (stats, stacks) = profile_call(work)
+    assert result == [610, 610, 610, 0]
+
+    stats = marshal.loads(stats)
+    work_stats = [s for func, s in stats.items() if func[2] == 'work'][0]
+
+    # every stack starts at the profiled function, and the stacks add up to its time
+    lines = [line for line in stacks.split("\n") if line.startswith("work ")]
+    assert len(lines) > 1
+    assert all(line.startswith("work (test_profiling.py:") for line in lines)
+    assert abs(sum(int(line.rsplit(" ", 1)[1]) for line in lines) - work_stats[3] * 1000000) <= len(lines)
+
+    # recursive calls are folded into the outermost one
+    assert len([line for line in lines if line.count("fib (") > 1]) == 0
+
+    save_profile((marshal.dumps(stats), stacks), str(tmp_path / "profile"))
+    assert pstats.Stats(str(tmp_path / "profile.pstats")).total_calls > 0
+    assert open(str(tmp_path / "profile.collapsed")).read() == stacks
+
+def test_collapsed_stacks():
+    # b is called from a and c, 3s from a and 1s from c, so its own time is split 3 to 1
+    a, b, c = ("a.py", 1, "a"), ("b.py", 1, "b;x"), ("~", 0, "<built-in method c>")
+    stats = {
+        a: (1, 1, 1.0, 6.0, {}),
+        c: (1, 1, 0.5, 1.5, {a: (1, 1, 0.5, 1.5)}),
+        b: (2, 2, 4.0, 4.0, {a: (1, 1, 3.0, 3.0), c: (1, 1, 1.0, 1.0)})
+    }
+    assert function_label(b) == "b,x (b.py:1)"
+    assert collapsed_stacks(stats) == "\n".join([
+        "a (a.py:1) 1000000",
+        "a (a.py:1);<built-in method c> 500000",
+        "a (a.py:1);<built-in method c>;b,x (b.py:1) 1000000",
+        "a (a.py:1);b,x (b.py:1) 3000000"
+    ]) + "\n"
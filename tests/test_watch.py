@@ -0,0 +1,147 @@
+import pytest, gzip, json, os, shutil
+
+from converter.watch import refresh, new_watch_state
+from converter.CVRs import cvr_index_path
+from converter.SEMSoutput import process_tallies_file
+from converter.outputs import OUTPUT_HASHES
+
+PARENT_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+SAMPLE_FILES = os.path.join(PARENT_DIR, 'sample_files')
+ELECTION_FILE = os.path.join(SAMPLE_FILES, '53_expected-election.json')
+TALLIES_FILE = os.path.join(SAMPLE_FILES, '53_tallies.json')
+EXPECTED_RESULTS_FILE = os.path.join(SAMPLE_FILES, '53_Results.txt')
+DOUBLED_EXPECTED_RESULTS_FILE = os.path.join(SAMPLE_FILES, '53_Results_Doubled.txt')
+CVRS_FILE = os.path.join(SAMPLE_FILES, 'CVRs.txt')
+
+def read_results(directory):
+    return open(os.path.join(directory, 'SEMS Results'), "rb").read()
+
+def test_refresh(tmp_path):
+    directory = str(tmp_path)
+    state = new_watch_state()
+
+    assert refresh(directory, state, 0) is None
+
+    shutil.copy(ELECTION_FILE, os.path.join(directory, 'Vx Election Definition'))
+
+    # nothing happens until the file has settled
+    assert refresh(directory, state, 1) is None
+    report = refresh(directory, state, 3)
+    assert report["error"] == "waiting for the election definition and tallies"
+
+    shutil.copy(TALLIES_FILE, os.path.join(directory, 'Vx Tallies'))
+    assert refresh(directory, state, 4) is None
+    report = refresh(directory, state, 6)
+    assert report["changed"] == ['Vx Tallies']
+    assert report["precinctsRendered"] == 20
+    assert read_results(directory) == open(EXPECTED_RESULTS_FILE, "rb").read()
+
+    # written like the server's outputs
+    results_path = os.path.join(directory, 'SEMS Results')
+    assert gzip.decompress(open(results_path + '.gz', "rb").read()) == read_results(directory)
+    assert results_path in OUTPUT_HASHES
+
+    # nothing changed
+    assert refresh(directory, state, 10) is None
+    index = state["index"]
+
+    # only the precinct with new tallies is rendered again
+    tallies = json.loads(open(TALLIES_FILE, "r").read())
+    tallies['talliesByPrecinct']['852']['775013573']['metadata']['undervotes'] = 1000
+    changed_tallies_file = str(tmp_path / 'changed-tallies.json')
+    open(changed_tallies_file, "w").write(json.dumps(tallies))
+    shutil.copy(changed_tallies_file, os.path.join(directory, 'Vx Tallies'))
+
+    refresh(directory, state, 11)
+    report = refresh(directory, state, 13)
+    assert report["precinctsRendered"] == 1
+    assert state["index"] is index
+    assert read_results(directory) == process_tallies_file(ELECTION_FILE, changed_tallies_file).encode('utf-8')
+
+def test_refresh_merge_and_cvrs(tmp_path):
+    directory = str(tmp_path)
+    state = new_watch_state()
+
+    shutil.copy(ELECTION_FILE, os.path.join(directory, 'Vx Election Definition'))
+    shutil.copy(TALLIES_FILE, os.path.join(directory, 'Vx Tallies'))
+    shutil.copy(EXPECTED_RESULTS_FILE, os.path.join(directory, 'SEMS Results to merge'))
+    shutil.copy(CVRS_FILE, os.path.join(directory, 'Vx CVRs'))
+
+    refresh(directory, state, 0)
+    report = refresh(directory, state, 2)
+    assert sorted(report["changed"]) == ['SEMS Results to merge', 'Vx CVRs', 'Vx Election Definition', 'Vx Tallies']
+    assert read_results(directory) == open(DOUBLED_EXPECTED_RESULTS_FILE, "rb").read()
+    assert os.path.isfile(cvr_index_path(os.path.join(directory, 'Vx CVRs')))
+
+def test_refresh_partially_written(tmp_path):
+    directory = str(tmp_path)
+    state = new_watch_state()
+
+    shutil.copy(ELECTION_FILE, os.path.join(directory, 'Vx Election Definition'))
+    open(os.path.join(directory, 'Vx Tallies'), "w").write(open(TALLIES_FILE, "r").read()[:1000])
+
+    refresh(directory, state, 0)
+    report = refresh(directory, state, 2)
+    assert report["error"].startswith("could not read the election definition or tallies")
+    assert not os.path.isfile(os.path.join(directory, 'SEMS Results'))
+
+    shutil.copy(TALLIES_FILE, os.path.join(directory, 'Vx Tallies'))
+    refresh(directory, state, 3)
+    report = refresh(directory, state, 5)
+    assert report["changed"] == ['Vx Tallies']
+    assert read_results(directory) == open(EXPECTED_RESULTS_FILE, "rb").read()
+
+def test_refresh_tallies_without_precincts(tmp_path):
+    directory = str(tmp_path)
+    state = new_watch_state()
+
+    shutil.copy(ELECTION_FILE, os.path.join(directory, 'Vx Election Definition'))
+    open(os.path.join(directory, 'Vx Tallies'), "w").write(json.dumps({"tallies": {}}))
+
+    refresh(directory, state, 0)
+    report = refresh(directory, state, 2)
+    assert "talliesByPrecinct" in report["error"]
+    assert not os.path.isfile(os.path.join(directory, 'SEMS Results'))
+
+def test_refresh_bad_merge_file(tmp_path):
+    directory = str(tmp_path)
+    state = new_watch_state()
+
+    shutil.copy(ELECTION_FILE, os.path.join(directory, 'Vx Election Definition'))
+    shutil.copy(TALLIES_FILE, os.path.join(directory, 'Vx Tallies'))
+    refresh(directory, state, 0)
+    refresh(directory, state, 2)
+
+    # a row with an empty count
+    open(os.path.join(directory, 'SEMS Results to merge'), "w").write('"53","852","775013573","DEM","1","SUE","2","0","DEM","Democratic","",\n')
+    refresh(directory, state, 3)
+    report = refresh(directory, state, 5)
+    assert report["changed"] == ['SEMS Results to merge']
+    assert report["error"].startswith("could not convert the tallies")
+    assert read_results(directory) == open(EXPECTED_RESULTS_FILE, "rb").read()
+
+    shutil.copy(EXPECTED_RESULTS_FILE, os.path.join(directory, 'SEMS Results to merge'))
+    refresh(directory, state, 6)
+    report = refresh(directory, state, 8)
+    assert "error" not in report
+    assert read_results(directory) == open(DOUBLED_EXPECTED_RESULTS_FILE, "rb").read()
+
+def test_refresh_bad_precinct_tallies(tmp_path):
+    directory = str(tmp_path)
+    state = new_watch_state()
+
+    tallies = json.loads(open(TALLIES_FILE, "r").read())
+    tallies['talliesByPrecinct']['852'] = []
+    shutil.copy(ELECTION_FILE, os.path.join(directory, 'Vx Election Definition'))
+    open(os.path.join(directory, 'Vx Tallies'), "w").write(json.dumps(tallies))
+
+    refresh(directory, state, 0)
+    report = refresh(directory, state, 2)
+    assert report["error"].startswith("could not convert the tallies")
+    assert not os.path.isfile(os.path.join(directory, 'SEMS Results'))
+
+    shutil.copy(TALLIES_FILE, os.path.join(directory, 'Vx Tallies'))
+    refresh(directory, state, 3)
+    report = refresh(directory, state, 5)
+    assert "error" not in report
+    assert read_results(directory) == open(EXPECTED_RESULTS_FILE, "rb").read()